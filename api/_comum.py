@@ -0,0 +1,748 @@
+"""Infraestrutura comum às rotas da API (extratos e procedimentos)
+
+O prefixo _ mantém o módulo fora das funções da Vercel; cada handler o importa do próprio diretório.
+Não importa pandas/numpy: o cold start das rotas não pode pagar esse custo.
+"""
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import json
+import glob
+import hashlib
+import base64
+import tempfile
+import logging
+import logging.handlers
+import queue
+import contextvars
+import atexit
+import sys
+import secrets
+import os
+import datetime
+import multiprocessing
+import contextlib
+import itertools
+import re
+import stat
+import threading
+import traceback
+import time
+import zlib
+
+# Log estruturado: uma linha JSON por evento, com o correlation ID da requisição e campos próprios
+# (tempos por etapa, contagens). Cada rota registra num logger filho de 'api' ('api.extratos', ...);
+# o caminho da requisição só enfileira, formatação e escrita no stdout ficam numa thread (QueueListener).
+# DEBUG liga os diagnósticos detalhados, desligados por padrão.
+LOG_NIVEL = os.environ.get('API_LOG_NIVEL', 'INFO').upper()
+REQUISICAO = contextvars.ContextVar('requisicao', default='-')
+ID_REQUISICAO_VALIDO = re.compile(r'[\w.-]{1,64}')
+log = logging.getLogger('api')
+OUVINTE_LOG = None
+
+class FormatoJson(logging.Formatter):
+    """Registro como uma linha JSON: campos fixos + campos estruturados do evento"""
+    def format(self, registro):
+        dados = {
+            'ts': datetime.datetime.fromtimestamp(registro.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'nivel': registro.levelname,
+            'logger': registro.name,
+            'requisicao': getattr(registro, 'requisicao', '-'),
+            'pid': registro.process,
+            'msg': registro.getMessage(),
+            **getattr(registro, 'campos', {})
+        }
+        return json.dumps(dados, ensure_ascii=False, default=str)
+
+class FilaLog(logging.handlers.QueueHandler):
+    """Só enfileira o registro: formatar e escrever fica com a thread do QueueListener"""
+    def prepare(self, registro):
+        return registro
+
+def anotar_requisicao(registro):
+    """Filtro do handler: carimba o correlation ID da requisição corrente (na thread que registrou)"""
+    registro.requisicao = REQUISICAO.get()
+    return True
+
+def configurar_log(em_fila=True):
+    """(Re)instala o handler do logger 'api'; em_fila=False escreve direto (processos de trabalho)"""
+    global OUVINTE_LOG
+    if OUVINTE_LOG is not None and em_fila:
+        return
+    for atual in list(log.handlers):
+        log.removeHandler(atual)
+    saida = logging.StreamHandler(sys.stdout)
+    saida.setFormatter(FormatoJson())
+    if em_fila:
+        fila = queue.SimpleQueue()
+        OUVINTE_LOG = logging.handlers.QueueListener(fila, saida)
+        OUVINTE_LOG.start()
+        entrada = FilaLog(fila)
+    else:
+        OUVINTE_LOG = None
+        entrada = saida
+    entrada.addFilter(anotar_requisicao)
+    log.addHandler(entrada)
+
+def encerrar_log():
+    """Esvazia a fila na saída do processo"""
+    if OUVINTE_LOG is not None:
+        OUVINTE_LOG.stop()
+
+def registrador(logger):
+    """Função registrar(nivel, mensagem, **campos) que registra um evento com campos estruturados no logger"""
+    def registrar(nivel, mensagem, **campos):
+        if logger.isEnabledFor(nivel):
+            logger.log(nivel, mensagem, extra={'campos': campos})
+    return registrar
+
+registrar = registrador(log)
+
+log.setLevel(LOG_NIVEL)
+log.propagate = False
+# Processos de trabalho saem sem rodar atexit: lá a escrita é direta, sem thread de fila
+configurar_log(em_fila=multiprocessing.parent_process() is None)
+atexit.register(encerrar_log)
+os.register_at_fork(after_in_child=lambda: configurar_log(em_fila=False))
+
+# Opções de requisição (form field ou query string)
+VALORES_VERDADEIROS = {'1', 'true', 'sim', 'yes', 'on'}
+
+# Serialização JSON: orjson quando instalado (gera bytes direto, sem str intermediária)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+TAMANHO_BLOCO_RESPOSTA = 64 * 1024
+
+# Compressão negociada via Accept-Encoding (brotli só se instalado)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+COMPRESSAO_MIN_BYTES = int(os.environ.get('COMPRESSAO_MIN_BYTES', '1024'))
+COMPRESSAO_NIVEL_GZIP = int(os.environ.get('COMPRESSAO_NIVEL_GZIP', '6'))
+COMPRESSAO_NIVEL_BROTLI = int(os.environ.get('COMPRESSAO_NIVEL_BROTLI', '5'))
+# .xlsx e .parquet já são comprimidos internamente
+TIPOS_COMPRIMIVEIS = {'application/json', 'application/x-ndjson', 'text/csv', 'application/vnd.apache.arrow.file'}
+
+# Excel por requisição: incluído em base64, omitido ou adiado (gerado no primeiro download e guardado no cache)
+MODOS_EXCEL = ('incluir', 'omitir', 'adiar')
+MODO_EXCEL_PADRAO = os.environ.get('EXCEL_MODO', 'incluir')
+TIPO_XLSX = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+CHAVE_VALIDA = re.compile(r'[0-9a-f]{64}')
+
+# Cache de resultados em disco (compartilhado entre processos do mesmo host e entre as rotas).
+# O diretório precisa ser privado (0700, do próprio usuário): no temp compartilhado outro usuário
+# poderia plantar entradas; se não for, o cache fica desligado
+CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'extrato-cache'))
+CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_MB', '256')) * 1024 * 1024
+CACHE_PRIVADO = None
+
+def cache_disponivel():
+    """Cache ligado e em diretório privado; a verificação roda uma vez por processo"""
+    global CACHE_PRIVADO
+    if CACHE_MAX_BYTES <= 0:
+        return False
+    if CACHE_PRIVADO is None:
+        try:
+            os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+            info = os.lstat(CACHE_DIR)
+            motivo = None
+            if not stat.S_ISDIR(info.st_mode):
+                motivo = 'não é um diretório (link simbólico?)'
+            elif info.st_uid != os.getuid():
+                motivo = 'pertence a outro usuário'
+            elif info.st_mode & 0o022:
+                motivo = 'aceita escrita de outros usuários'
+            elif info.st_mode & 0o077:
+                # Do próprio usuário e sem escrita alheia (ex.: 0755 de versões anteriores): basta fechar a leitura
+                os.chmod(CACHE_DIR, 0o700)
+        except OSError as e:
+            motivo = str(e)
+        if motivo:
+            registrar(logging.WARNING, 'cache de resultados desligado: diretório não é privado', diretorio=CACHE_DIR, motivo=motivo)
+        CACHE_PRIVADO = motivo is None
+    return CACHE_PRIVADO
+
+def env_numero(nome, padrao, tipo=int):
+    """Número não negativo da variável de ambiente; valor inválido registra um aviso e fica o padrão (não derruba a importação)"""
+    texto = os.environ.get(nome, '').strip()
+    if not texto:
+        return padrao
+    try:
+        valor = tipo(texto)
+        if valor < 0:
+            raise ValueError('valor negativo')
+    except ValueError as e:
+        registrar(logging.WARNING, 'variável de ambiente inválida, usando o padrão', variavel=nome, valor=texto, padrao=padrao, erro=str(e))
+        return padrao
+    return valor
+
+def env_fatores(nome, padrao):
+    """Lista formato=fator da variável de ambiente (ex.: csv=20,xlsx=80); lista inválida registra um aviso e fica o padrão"""
+    texto = os.environ.get(nome, '').strip()
+    if not texto:
+        return dict(padrao)
+    try:
+        fatores = {}
+        for par in texto.split(','):
+            formato, fator = (parte.strip() for parte in par.split('='))
+            if not float(fator) > 0:
+                raise ValueError(f'fator de {formato} precisa ser positivo')
+            fatores[formato.lower()] = float(fator)
+    except ValueError as e:
+        registrar(logging.WARNING, 'variável de ambiente inválida, usando o padrão', variavel=nome, valor=texto, padrao=padrao, erro=str(e))
+        return dict(padrao)
+    return fatores
+
+def memoria_fisica():
+    """Memória física do host em bytes (0 se o sistema não informa)"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+class OrcamentoMemoria:
+    """Orçamento de memória do processo, único para todas as rotas: bytes reservados e fila de espera sob uma Condition"""
+
+    def __init__(self, limite, fila_max, espera_s):
+        self.limite = limite
+        self.fila_max = fila_max
+        self.espera_s = espera_s
+        self.reservada = 0
+        self.fila = 0
+        self.condicao = threading.Condition()
+
+    def ajustar(self, atual, estimativa, espera=contextlib.nullcontext):
+        """Leva uma reserva de atual para estimativa bytes, esperando na fila se preciso; devolve None ou (status, mensagem) da recusa"""
+        adicional = estimativa - atual
+        with self.condicao:
+            if adicional > 0 and self.reservada + adicional > self.limite:
+                if self.fila >= self.fila_max:
+                    return (429, "Servidor ocupado: fila de processamento cheia")
+                # Espera na fila até outra requisição (de qualquer rota) liberar memória
+                self.fila += 1
+                try:
+                    with espera():
+                        admitida = self.condicao.wait_for(lambda: self.reservada + adicional <= self.limite, timeout=self.espera_s)
+                finally:
+                    self.fila -= 1
+                if not admitida:
+                    return (503, "Memória do servidor esgotada: tente novamente em instantes")
+            self.reservada += adicional
+            if adicional < 0:
+                self.condicao.notify_all()
+        return None
+
+    def liberar(self, reserva):
+        """Devolve uma reserva ao orçamento e acorda quem espera na fila"""
+        with self.condicao:
+            self.reservada -= reserva
+            self.condicao.notify_all()
+
+# Controle de admissão: memória estimada da requisição (bytes de cada arquivo x fator do formato da rota)
+# contra um único orçamento do processo (0 = metade da memória física). Sem espaço, a requisição espera
+# na fila até API_ADMISSAO_ESPERA_S (503 ao estourar; 429 com a fila cheia); acima do orçamento
+# inteiro ou do limite de upload é recusada com 413
+MEMORIA_MAX_BYTES = env_numero('API_MEMORIA_MAX_MB', 0) * 1024 * 1024 or memoria_fisica() // 2 or 2 * 1024 ** 3
+UPLOAD_MAX_BYTES = env_numero('API_UPLOAD_MAX_MB', 200) * 1024 * 1024
+ADMISSAO_RETRY_AFTER_S = 5
+ORCAMENTO_MEMORIA = OrcamentoMemoria(MEMORIA_MAX_BYTES, env_numero('API_ADMISSAO_FILA', 8), env_numero('API_ADMISSAO_ESPERA_S', 30.0, float))
+# Acima de API_EM_MEMORIA_MAX_MB estimados a requisição não é processada em memória: cada rota lê em blocos
+# a partir do disco o que sabe ler assim (extrato CSV do Banco do Brasil) e recusa o restante com 413
+EM_MEMORIA_MAX_BYTES = env_numero('API_EM_MEMORIA_MAX_MB', 512) * 1024 * 1024
+
+def versao_codigo(arquivo):
+    """Hash curto da fonte da rota e dos módulos comuns (api/_*.py): muda a cada deploy e invalida o cache"""
+    h = hashlib.sha256()
+    for fonte in [arquivo, *sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '_*.py')))]:
+        with open(fonte, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+class HandlerBase(BaseHTTPRequestHandler):
+    """Base dos handlers das rotas: log estruturado da requisição, opções, envio da resposta (JSON/NDJSON comprimido) e cache de resultados"""
+    # Cada rota troca pelo registrar do próprio logger
+    registrar = staticmethod(registrar)
+    # Campos da resposta que já vão em eventos próprios no NDJSON (o restante segue no evento 'fim')
+    CAMPOS_EVENTOS = frozenset()
+    # Cache de resultados: prefixo da chave, nome do Excel baixado e versão do código de cada rota
+    ROTA = 'api'
+    NOME_DOWNLOAD_EXCEL = 'Analise.xlsx'
+    VERSAO_CODIGO = versao_codigo(__file__)
+    # Admissão: multiplicador de memória por formato de upload (custo do parse de cada rota)
+    FATORES_MEMORIA = {'csv': 20, 'xls': 20, 'xlsx': 80}
+
+    def iniciar_requisicao(self):
+        """Correlation ID (X-Request-ID do cliente ou gerado), tempos por etapa e reserva de memória desta requisição"""
+        recebido = self.headers.get('X-Request-ID', '')
+        self.id_requisicao = recebido if ID_REQUISICAO_VALIDO.fullmatch(recebido) else secrets.token_hex(8)
+        REQUISICAO.set(self.id_requisicao)
+        self.tempos_etapas = {}
+        self.inicio_requisicao = time.perf_counter()
+        self.memoria_reservada = 0
+        self.bytes_pendentes = 0
+
+    @contextlib.contextmanager
+    def etapa(self, nome):
+        """Mede uma etapa do processamento; os tempos vão como campo no registro de conclusão"""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            duracao = (time.perf_counter() - inicio) * 1000
+            self.tempos_etapas[nome] = round(self.tempos_etapas.get(nome, 0) + duracao, 1)
+            self.registrar(logging.DEBUG, 'etapa concluída', etapa=nome, duracao_ms=round(duracao, 1))
+
+    def concluir_requisicao(self, **campos):
+        """Registro final da requisição com a duração total e os tempos por etapa (para agregação offline)"""
+        self.registrar(logging.INFO, 'processamento concluído', duracao_ms=round((time.perf_counter() - self.inicio_requisicao) * 1000, 1),
+                       etapas=self.tempos_etapas, **campos)
+
+    def log_message(self, format, *args):
+        """Linha de acesso do BaseHTTPRequestHandler pelo log estruturado (em vez de escrever no stderr)"""
+        self.registrar(logging.INFO, 'acesso', cliente=self.address_string(), linha=format % args)
+
+    def formato_upload(self, dados):
+        """Formato do arquivo pelos primeiros bytes: xlsx (zip), xls (OLE2) ou texto (csv)"""
+        if dados[:4] == b'PK\x03\x04':
+            return 'xlsx'
+        if dados[:8] == b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1':
+            return 'xls'
+        return 'csv'
+
+    def estimar_memoria(self, arquivos):
+        """Pico de memória estimado do processamento: bytes de cada arquivo x fator do formato na rota"""
+        fator_padrao = max(self.FATORES_MEMORIA.values())
+        return int(sum(len(dados) * self.FATORES_MEMORIA.get(self.formato_upload(dados), fator_padrao)
+                       for dados in arquivos.values()))
+
+    def admitir(self, estimativa):
+        """Ajusta a reserva da requisição no orçamento do processo; recusada, responde 413/429/503 e devolve False"""
+        if estimativa > ORCAMENTO_MEMORIA.limite:
+            self.recusar(413, f"Requisição estimada em {estimativa / 1024 / 1024:.0f} MB de memória excede o limite de "
+                              f"{ORCAMENTO_MEMORIA.limite / 1024 / 1024:.0f} MB", memoria_estimada=estimativa)
+            return False
+        recusa = ORCAMENTO_MEMORIA.ajustar(self.memoria_reservada, estimativa, espera=lambda: self.etapa('admissao'))
+        if recusa is not None:
+            self.recusar(*recusa, memoria_estimada=estimativa)
+            return False
+        self.memoria_reservada = estimativa
+        return True
+
+    def liberar_memoria(self):
+        """Devolve a reserva da requisição ao orçamento"""
+        if self.memoria_reservada:
+            ORCAMENTO_MEMORIA.liberar(self.memoria_reservada)
+            self.memoria_reservada = 0
+
+    def descartar_corpo(self):
+        """Lê e descarta em blocos o corpo ainda não lido, para o cliente receber a recusa em vez de um erro de envio"""
+        while self.bytes_pendentes > 0:
+            bloco = self.rfile.read(min(self.bytes_pendentes, TAMANHO_BLOCO_RESPOSTA))
+            if not bloco:
+                break
+            self.bytes_pendentes -= len(bloco)
+        self.bytes_pendentes = 0
+
+    def receber_em_disco(self, arquivo):
+        """Copia em blocos o corpo ainda não lido para o arquivo (o corpo inteiro nunca fica em memória)"""
+        while self.bytes_pendentes > 0:
+            bloco = self.rfile.read(min(self.bytes_pendentes, TAMANHO_BLOCO_RESPOSTA))
+            if not bloco:
+                raise Exception("Corpo da requisição incompleto")
+            arquivo.write(bloco)
+            self.bytes_pendentes -= len(bloco)
+        arquivo.flush()
+
+    def recusar(self, status, mensagem, **campos):
+        """Resposta de recusa; 429/503 levam Retry-After"""
+        self.registrar(logging.WARNING, 'requisição recusada', status=status, erro=mensagem,
+                       memoria_reservada=ORCAMENTO_MEMORIA.reservada, fila=ORCAMENTO_MEMORIA.fila, **campos)
+        try:
+            self.descartar_corpo()
+        except OSError:
+            self.close_connection = True
+        cabecalhos = {'Retry-After': str(ADMISSAO_RETRY_AFTER_S)} if status in (429, 503) else None
+        self.enviar_json({'success': False, 'error': mensagem}, status=status, cabecalhos=cabecalhos)
+
+    def enviar_json(self, resposta, status=200, cabecalhos=None):
+        """Envia resposta JSON com cabeçalhos CORS"""
+        self.enviar_resposta(self.serializar_json(resposta), 'application/json', status, cabecalhos)
+
+    def enviar_resposta(self, blocos, tipo_conteudo, status=200, cabecalhos=None, progressivo=False):
+        """Envia blocos de bytes (chunked para HTTP/1.1), comprimindo conforme Accept-Encoding
+        
+        progressivo: cada bloco sai assim que é gerado (compressão com flush por bloco)
+        """
+        blocos = iter(blocos)
+        codificacao = self.negociar_codificacao() if tipo_conteudo in TIPOS_COMPRIMIVEIS else None
+        
+        if codificacao and progressivo:
+            blocos = self.comprimir_blocos(blocos, codificacao, descarregar=True)
+        elif codificacao:
+            # Respostas abaixo do tamanho mínimo seguem sem compressão
+            iniciais = []
+            tamanho = 0
+            for bloco in blocos:
+                iniciais.append(bloco)
+                tamanho += len(bloco)
+                if tamanho >= COMPRESSAO_MIN_BYTES:
+                    break
+            else:
+                codificacao = None
+            blocos = itertools.chain(iniciais, blocos)
+            if codificacao:
+                blocos = self.comprimir_blocos(blocos, codificacao)
+        
+        chunked = self.request_version == 'HTTP/1.1'
+        if chunked:
+            self.protocol_version = 'HTTP/1.1'
+        
+        self.send_response(status)
+        self.send_header('Content-Type', tipo_conteudo)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('X-Request-ID', self.id_requisicao)
+        for nome, valor in (cabecalhos or {}).items():
+            self.send_header(nome, valor)
+        if tipo_conteudo in TIPOS_COMPRIMIVEIS:
+            self.send_header('Vary', 'Accept-Encoding')
+        if codificacao:
+            self.send_header('Content-Encoding', codificacao)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        
+        for bloco in blocos:
+            if not bloco:
+                continue
+            if chunked:
+                self.wfile.write(f'{len(bloco):X}\r\n'.encode())
+                self.wfile.write(bloco)
+                self.wfile.write(b'\r\n')
+            else:
+                self.wfile.write(bloco)
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def serializar_json(self, resposta):
+        """Gera o JSON da resposta em blocos de bytes de até TAMANHO_BLOCO_RESPOSTA"""
+        if orjson is not None:
+            dados = memoryview(orjson.dumps(resposta))
+            for inicio in range(0, len(dados), TAMANHO_BLOCO_RESPOSTA):
+                yield dados[inicio:inicio + TAMANHO_BLOCO_RESPOSTA]
+            return
+        
+        pendentes = []
+        tamanho = 0
+        for fragmento in self.fragmentos_json(resposta):
+            pendentes.append(fragmento)
+            tamanho += len(fragmento)
+            if tamanho >= TAMANHO_BLOCO_RESPOSTA:
+                yield ''.join(pendentes).encode()
+                pendentes = []
+                tamanho = 0
+        if pendentes:
+            yield ''.join(pendentes).encode()
+
+    def fragmentos_json(self, valor):
+        """Percorre listas/dicts aninhados e codifica as folhas com o encoder C do json"""
+        if isinstance(valor, dict) and any(isinstance(item, (dict, list)) for item in valor.values()):
+            yield '{'
+            for i, (chave, item) in enumerate(valor.items()):
+                yield (', ' if i else '') + json.dumps(str(chave)) + ': '
+                yield from self.fragmentos_json(item)
+            yield '}'
+        elif isinstance(valor, list) and any(isinstance(item, (dict, list)) for item in valor[:1]):
+            yield '['
+            for i, item in enumerate(valor):
+                if i:
+                    yield ', '
+                yield from self.fragmentos_json(item)
+            yield ']'
+        else:
+            yield json.dumps(valor)
+
+    def negociar_codificacao(self):
+        """Escolhe br ou gzip conforme Accept-Encoding (q-values); None = sem compressão"""
+        aceitas = {}
+        for parte in self.headers.get('Accept-Encoding', '').split(','):
+            nome, _, parametros = parte.partition(';')
+            nome = nome.strip().lower()
+            if not nome:
+                continue
+            qualidade = 1.0
+            parametros = parametros.strip().replace(' ', '')
+            if parametros.startswith('q='):
+                try:
+                    qualidade = float(parametros[2:])
+                except ValueError:
+                    qualidade = 0.0
+            aceitas[nome] = qualidade
+        
+        # Preferência do servidor em caso de empate: br, depois gzip
+        disponiveis = (['br'] if brotli is not None else []) + ['gzip']
+        melhor = None
+        for codificacao in disponiveis:
+            qualidade = aceitas.get(codificacao, aceitas.get('*', 0.0))
+            if qualidade > 0 and (melhor is None or qualidade > melhor[1]):
+                melhor = (codificacao, qualidade)
+        return melhor[0] if melhor else None
+
+    def comprimir_blocos(self, blocos, codificacao, descarregar=False):
+        """Comprime os blocos em streaming (gzip ou brotli); descarregar=True emite cada bloco já decodificável"""
+        if codificacao == 'br':
+            compressor = brotli.Compressor(quality=COMPRESSAO_NIVEL_BROTLI)
+            for bloco in blocos:
+                yield compressor.process(bytes(bloco))
+                if descarregar:
+                    yield compressor.flush()
+            yield compressor.finish()
+        else:
+            compressor = zlib.compressobj(COMPRESSAO_NIVEL_GZIP, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            for bloco in blocos:
+                yield compressor.compress(bloco)
+                if descarregar:
+                    yield compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield compressor.flush()
+
+    def opcao_progressiva(self, form_data):
+        """Resposta em NDJSON: opção 'stream' ou, sem ela, Accept: application/x-ndjson"""
+        return self.opcao_ativa(form_data, 'stream', 'application/x-ndjson' in self.headers.get('Accept', ''))
+
+    def resposta_das_etapas(self, etapas):
+        """Consome os eventos do pipeline e devolve a resposta completa (modo JSON)"""
+        while True:
+            try:
+                next(etapas)
+            except StopIteration as fim:
+                return fim.value
+
+    def eventos_finais(self, resposta):
+        """Referência ao Excel (base64 ou URL de download) e o evento de fim com os demais campos"""
+        yield {'tipo': 'excel', 'excel_file': resposta.get('excel_file'), 'excel_url': resposta.get('excel_url')}
+        extras = {chave: valor for chave, valor in resposta.items() if chave not in self.CAMPOS_EVENTOS}
+        yield {'tipo': 'fim', **extras}
+
+    def eventos_resposta(self, resposta):
+        """Resposta completa (ex.: do cache) como a mesma sequência de eventos (eventos_resultados é de cada rota)"""
+        yield from self.eventos_resultados(resposta)
+        yield from self.eventos_finais(resposta)
+
+    def enviar_eventos(self, eventos, cabecalhos=None):
+        """Envia os eventos como NDJSON, uma linha por evento, sem esperar o pipeline terminar"""
+        # Proxies (nginx) não devem segurar a resposta em buffer
+        cabecalhos = {'X-Accel-Buffering': 'no', **(cabecalhos or {})}
+        self.enviar_resposta(self.linhas_ndjson(eventos), 'application/x-ndjson', cabecalhos=cabecalhos, progressivo=True)
+
+    def linhas_ndjson(self, eventos):
+        """Serializa os eventos; erro depois dos cabeçalhos enviados vira um evento 'erro' no fim do stream"""
+        try:
+            for evento in eventos:
+                yield b''.join(self.serializar_json(evento)) + b'\n'
+        except Exception as e:
+            detalhes = traceback.format_exc()
+            self.registrar(logging.ERROR, 'falha no processamento', erro=str(e), traceback=detalhes, etapas=self.tempos_etapas)
+            yield b''.join(self.serializar_json({'tipo': 'erro', 'success': False, 'error': str(e), 'traceback': detalhes})) + b'\n'
+
+    def opcao_texto(self, form_data, nome, padrao=None):
+        """Lê opção do formulário ou da query string"""
+        valor = form_data.get(nome)
+        if valor is None:
+            valor = parse_qs(urlparse(self.path).query).get(nome, [None])[0]
+        return padrao if valor is None else valor.strip()
+
+    def opcao_ativa(self, form_data, nome, padrao=False):
+        """Lê opção booleana do formulário ou da query string"""
+        valor = self.opcao_texto(form_data, nome)
+        if valor is None:
+            return padrao
+        return valor.lower() in VALORES_VERDADEIROS
+
+    def opcao_modo_excel(self, form_data, formatos):
+        """Modo do Excel (incluir, omitir ou adiar); sem 'xlsx' nos formatos é sempre omitir"""
+        modo = self.opcao_texto(form_data, 'excel', MODO_EXCEL_PADRAO).lower()
+        if modo not in MODOS_EXCEL:
+            raise Exception(f"Modo de Excel inválido: {modo} (use {', '.join(MODOS_EXCEL)})")
+        if 'xlsx' not in formatos:
+            return 'omitir'
+        # Sem cache em disco não há onde guardar o Excel adiado
+        if modo == 'adiar' and not cache_disponivel():
+            return 'incluir'
+        return modo
+
+    def url_excel(self, chave):
+        """Endereço de download do Excel adiado (mesma rota da requisição)"""
+        return f"{urlparse(self.path).path}?excel={chave}"
+
+    def chave_cache(self, *conteudos, opcoes=None):
+        """Chave do cache: hash dos arquivos enviados, opções e versão do código"""
+        h = hashlib.sha256(f'{self.ROTA}:{self.VERSAO_CODIGO}'.encode())
+        for conteudo in conteudos:
+            h.update(len(conteudo).to_bytes(8, 'big'))
+            h.update(conteudo)
+        h.update(json.dumps(opcoes or {}, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def ler_cache(self, chave, modo_excel='incluir'):
+        """Retorna a resposta em cache (com o Excel conforme o modo) ou None"""
+        if not cache_disponivel():
+            return None
+        
+        caminho_json = os.path.join(CACHE_DIR, f'{chave}.json')
+        try:
+            with open(caminho_json, 'rb') as f:
+                resposta = json.loads(f.read())
+            
+            # Entrada gravada sem Excel não serve a quem pede o Excel
+            resposta['excel_file'] = None
+            if modo_excel == 'adiar':
+                if not any(os.path.exists(os.path.join(CACHE_DIR, chave + extensao)) for extensao in ('.xlsx', '.abas')):
+                    return None
+                resposta['excel_url'] = self.url_excel(chave)
+            elif modo_excel == 'incluir':
+                excel = self.ler_excel_cache(chave)
+                if excel is None:
+                    return None
+                resposta['excel_file'] = base64.b64encode(excel).decode()
+            
+            # Atualizar mtime mantém a ordem LRU entre processos
+            os.utime(caminho_json)
+            return resposta
+        except (OSError, ValueError):
+            return None
+
+    def ler_excel_cache(self, chave):
+        """Excel da entrada: pronto (.xlsx) ou montado agora a partir das abas adiadas (.abas); None se não houver"""
+        if not cache_disponivel():
+            return None
+        # _xlsx importa _comum (via _processos): importado no uso
+        from _xlsx import montar_xlsx, desserializar_abas
+        
+        caminho_xlsx = os.path.join(CACHE_DIR, f'{chave}.xlsx')
+        caminho_abas = os.path.join(CACHE_DIR, f'{chave}.abas')
+        try:
+            with open(caminho_xlsx, 'rb') as f:
+                excel = f.read()
+            os.utime(caminho_xlsx)
+            return excel
+        except FileNotFoundError:
+            pass
+        
+        try:
+            with open(caminho_abas, 'rb') as f:
+                abas = desserializar_abas(f.read())
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError) as e:
+            # Conteúdo inválido (ou de uma versão anterior) conta como ausente
+            self.registrar(logging.WARNING, 'abas adiadas inválidas no cache', chave=chave, erro=str(e))
+            return None
+        
+        # Primeiro download: monta uma vez e substitui as abas pelo .xlsx
+        excel = montar_xlsx(abas)
+        self.escrever_atomico(caminho_xlsx, excel)
+        try:
+            os.remove(caminho_abas)
+        except FileNotFoundError:
+            pass
+        return excel
+
+    def adiar_excel(self, chave, abas):
+        """Guarda as abas já descritas (JSON) para montar o Excel no primeiro download; retorna a URL ou None"""
+        from _xlsx import serializar_abas
+        if not cache_disponivel():
+            return None
+        try:
+            self.escrever_atomico(os.path.join(CACHE_DIR, f'{chave}.abas'), serializar_abas(abas))
+            return self.url_excel(chave)
+        except OSError as e:
+            self.registrar(logging.WARNING, 'falha ao adiar Excel', erro=str(e))
+            return None
+
+    def enviar_excel(self, chave):
+        """Download do Excel de uma entrada do cache (/...?excel=<chave>)"""
+        if not CHAVE_VALIDA.fullmatch(chave):
+            self.enviar_json({'success': False, 'error': 'Chave de Excel inválida'}, status=400)
+            return
+        
+        excel = self.ler_excel_cache(chave)
+        if excel is None:
+            self.enviar_json({'success': False, 'error': 'Excel não encontrado (expirou do cache?)'}, status=404)
+            return
+        
+        self.enviar_resposta([excel], TIPO_XLSX, cabecalhos={
+            'Content-Disposition': f'attachment; filename="{self.NOME_DOWNLOAD_EXCEL}"'
+        })
+
+    def gravar_cache(self, chave, resposta):
+        """Grava JSON e Excel no cache de forma atômica e aplica o limite de tamanho"""
+        if not cache_disponivel():
+            return
+        
+        try:
+            dados = dict(resposta)
+            excel_b64 = dados.pop('excel_file', None)
+            dados.pop('excel_url', None)
+            
+            # Excel primeiro: o JSON só aparece quando a entrada está completa
+            if excel_b64:
+                self.escrever_atomico(os.path.join(CACHE_DIR, f'{chave}.xlsx'), base64.b64decode(excel_b64))
+            self.escrever_atomico(os.path.join(CACHE_DIR, f'{chave}.json'), json.dumps(dados).encode())
+            
+            self.limpar_cache()
+        except OSError as e:
+            self.registrar(logging.WARNING, 'falha ao gravar cache', erro=str(e))
+
+    def escrever_atomico(self, caminho, conteudo):
+        """Escreve em arquivo temporário e renomeia (seguro entre processos)"""
+        fd, temporario = tempfile.mkstemp(dir=os.path.dirname(caminho), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(conteudo)
+            os.replace(temporario, caminho)
+        except OSError:
+            if os.path.exists(temporario):
+                os.remove(temporario)
+            raise
+
+    def limpar_cache(self):
+        """Remove as entradas menos usadas até o cache caber no limite"""
+        entradas = {}
+        for entrada in os.scandir(CACHE_DIR):
+            chave, extensao = os.path.splitext(entrada.name)
+            if extensao not in ('.json', '.xlsx', '.abas'):
+                continue
+            try:
+                info = entrada.stat()
+            except FileNotFoundError:
+                continue
+            tamanho, ultimo_uso = entradas.get(chave, (0, 0))
+            entradas[chave] = (tamanho + info.st_size, max(ultimo_uso, info.st_mtime))
+        
+        total = sum(tamanho for tamanho, _ in entradas.values())
+        for chave, (tamanho, _) in sorted(entradas.items(), key=lambda item: item[1][1]):
+            if total <= CACHE_MAX_BYTES:
+                break
+            for extensao in ('.json', '.xlsx', '.abas'):
+                try:
+                    os.remove(os.path.join(CACHE_DIR, chave + extensao))
+                except FileNotFoundError:
+                    pass
+            total -= tamanho
+
+    def nova_aba(self, abas, nome):
+        """Cria a descrição de uma aba (renderizada depois por montar_xlsx)"""
+        aba = {'nome': nome, 'linhas': [], 'larguras': {}}
+        abas.append(aba)
+        return aba
+
+    def adicionar_linha(self, aba, valores, estilos=None):
+        """Acrescenta uma linha com estilos por coluna ({coluna: nome_do_estilo})"""
+        aba['linhas'].append((valores, estilos))
+
+    def adicionar_colunas(self, aba, colunas, estilos=None):
+        """Acrescenta um bloco de linhas em forma de colunas (arrays do mesmo tamanho), renderizado vetorizado após as linhas"""
+        aba['colunas'] = (colunas, estilos)
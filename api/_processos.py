@@ -0,0 +1,191 @@
+"""Processos de trabalho compartilhados pelas rotas (parse do modo consolidado, montagem do Excel)
+
+Um único pool por processo, criado no primeiro uso e mantido entre as requisições. Os workers partem
+de forkserver (ou spawn), nunca de fork: o servidor é multithread e o fork copiaria locks presos por
+outras threads. Sem pool (sandbox sem semáforos, worker morto) o trabalho segue em série.
+Como no spawn, os workers reimportam o módulo principal: scripts que sobem o servidor usam if __name__ == '__main__'.
+"""
+import os
+import logging
+import atexit
+import time
+import pickle
+import threading
+import multiprocessing
+import contextlib
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from _comum import registrar, configurar_log
+
+# pandas/numpy só na troca de colunas com os workers (carregar_dependencias)
+pd = np = None
+
+# Tamanho do pool (0 = um processo por núcleo; 1 desativa o paralelismo)
+PROCESSOS_WORKERS = int(os.environ.get('PROCESSOS_WORKERS', '0')) or os.cpu_count() or 1
+
+# Troca de dados com os processos de trabalho por arquivos mapeados em memória (em vez de pickle pelo pipe):
+# entradas brutas e colunas já parseadas; /dev/shm quando disponível (fica em RAM)
+DIRETORIO_COMPARTILHADO = os.environ.get('DIRETORIO_COMPARTILHADO') or (
+    '/dev/shm' if os.access('/dev/shm', os.W_OK) else tempfile.gettempdir()
+)
+# Cada processo usa só o seu handoff-<pid>; os de processos mortos (crash, SIGKILL) são varridos no primeiro uso.
+# Diretórios sem pid (versões anteriores) só saem depois de HANDOFF_IDADE_MAX_S
+PREFIXO_HANDOFF = 'handoff-'
+HANDOFF_IDADE_MAX_S = 3600
+DIRETORIOS_PROCESSO = set()
+TRAVA_HANDOFF = threading.Lock()
+
+POOL = None
+POOL_TRAVA = threading.Lock()
+
+def carregar_dependencias():
+    """Importa pandas/numpy na primeira vez que são necessários (idempotente)"""
+    global pd, np
+    if pd is None:
+        import numpy
+        import pandas
+        np, pd = numpy, pandas
+
+def obter_pool():
+    """Pool do processo, criado na primeira chamada; o forkserver já sobe com pandas/numpy importados"""
+    global POOL
+    with POOL_TRAVA:
+        if POOL is None:
+            metodos = multiprocessing.get_all_start_methods()
+            contexto = multiprocessing.get_context('forkserver' if 'forkserver' in metodos else 'spawn')
+            if contexto.get_start_method() == 'forkserver':
+                contexto.set_forkserver_preload(['numpy', 'pandas', '_xlsx'])
+            # Nos workers o log escreve direto no stdout (sem a thread da fila)
+            POOL = ProcessPoolExecutor(max_workers=PROCESSOS_WORKERS, mp_context=contexto,
+                                       initializer=configurar_log, initargs=(False,))
+        return POOL
+
+def descartar_pool(pool):
+    """Tira de uso um pool quebrado; a próxima chamada cria outro"""
+    global POOL
+    with POOL_TRAVA:
+        if POOL is pool:
+            POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def mapear_em_processos(funcao, itens, paralelo=True):
+    """funcao(item) para cada item no pool do processo, na ordem da entrada; em série se não paralelo ou se o pool falhar
+
+    funcao precisa ser importável pelo nome do módulo (os workers não herdam a memória do servidor).
+    """
+    if paralelo and PROCESSOS_WORKERS > 1 and len(itens) > 1:
+        pool = None
+        try:
+            pool = obter_pool()
+            return list(pool.map(funcao, itens))
+        except BrokenProcessPool as e:
+            descartar_pool(pool)
+            registrar(logging.WARNING, 'pool de processos quebrado, seguindo em série', erro=str(e))
+        except (OSError, ImportError, NotImplementedError, pickle.PicklingError) as e:
+            registrar(logging.WARNING, 'processamento paralelo indisponível, seguindo em série', erro=str(e))
+    return [funcao(item) for item in itens]
+
+def processo_vivo(pid):
+    """Se o pid ainda existe (sinal 0 só verifica)"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def varrer_handoff():
+    """Remove os diretórios de troca deixados por processos que terminaram sem limpar"""
+    try:
+        entradas = list(os.scandir(DIRETORIO_COMPARTILHADO))
+    except OSError:
+        return
+    for entrada in entradas:
+        if not entrada.name.startswith(PREFIXO_HANDOFF):
+            continue
+        try:
+            info = entrada.stat(follow_symlinks=False)
+        except OSError:
+            continue
+        # Em /dev/shm compartilhado, só os diretórios do próprio usuário
+        if not entrada.is_dir(follow_symlinks=False) or info.st_uid != os.getuid():
+            continue
+        pid = entrada.name[len(PREFIXO_HANDOFF):]
+        if pid.isdigit():
+            if int(pid) == os.getpid() or processo_vivo(int(pid)):
+                continue
+        elif time.time() - info.st_mtime < HANDOFF_IDADE_MAX_S:
+            continue
+        shutil.rmtree(entrada.path, ignore_errors=True)
+        registrar(logging.INFO, 'diretório de troca abandonado removido', diretorio=entrada.path)
+
+def diretorio_processo():
+    """handoff-<pid> deste processo: criado no primeiro uso (depois da varredura) e removido na saída"""
+    caminho = os.path.join(DIRETORIO_COMPARTILHADO, f'{PREFIXO_HANDOFF}{os.getpid()}')
+    with TRAVA_HANDOFF:
+        if caminho not in DIRETORIOS_PROCESSO:
+            varrer_handoff()
+            # Sobra de um processo antigo com o mesmo pid
+            shutil.rmtree(caminho, ignore_errors=True)
+            os.makedirs(caminho, mode=0o700)
+            atexit.register(shutil.rmtree, caminho, True)
+            DIRETORIOS_PROCESSO.add(caminho)
+    return caminho
+
+@contextlib.contextmanager
+def diretorio_compartilhado():
+    """Diretório temporário da troca de dados com os workers (em RAM quando há /dev/shm), removido ao sair"""
+    diretorio = tempfile.mkdtemp(dir=diretorio_processo())
+    try:
+        yield diretorio
+    finally:
+        # Mapeamentos já abertos continuam válidos após a remoção (o arquivo só some quando o último fecha)
+        shutil.rmtree(diretorio, ignore_errors=True)
+
+def exportar_colunas(colunas, diretorio, prefixo):
+    """Grava cada coluna como .npy no diretório compartilhado e devolve o descritor (leve, sem os dados) que vai pelo pickle
+
+    Numéricas e datas vão como estão; categóricas como códigos + categorias; texto fatorado em códigos + valores únicos.
+    """
+    carregar_dependencias()
+    descritor = []
+    for nome, valores in colunas.items():
+        serie = valores if isinstance(valores, pd.Series) else pd.Series(valores)
+        caminho = os.path.join(diretorio, f'{prefixo}-{len(descritor)}.npy')
+        if isinstance(serie.dtype, pd.CategoricalDtype):
+            np.save(caminho, serie.cat.codes.to_numpy())
+            descritor.append((nome, caminho, 'categoria', (list(serie.cat.categories), serie.cat.ordered)))
+        elif isinstance(serie.dtype, np.dtype) and serie.dtype.kind in 'biufmM':
+            np.save(caminho, serie.to_numpy())
+            descritor.append((nome, caminho, 'array', None))
+        else:
+            codigos, unicos = pd.factorize(serie)
+            np.save(caminho, codigos)
+            descritor.append((nome, caminho, 'fatorado', (list(unicos), serie.dtype)))
+    return descritor
+
+def importar_colunas(descritor, texto_como_categoria=False):
+    """Reconstrói as colunas de exportar_colunas mapeando os arquivos (copy-on-write: os dados numéricos não são copiados)
+
+    texto_como_categoria devolve o texto fatorado como categórica (códigos + únicos), sem materializar as strings.
+    """
+    carregar_dependencias()
+    colunas = {}
+    for nome, caminho, tipo, extra in descritor:
+        dados = np.load(caminho, mmap_mode='c')
+        if tipo == 'array':
+            colunas[nome] = pd.Series(dados, copy=False)
+        elif tipo == 'categoria':
+            categorias, ordenada = extra
+            colunas[nome] = pd.Series(pd.Categorical.from_codes(dados, categorias, ordered=ordenada))
+        elif texto_como_categoria:
+            colunas[nome] = pd.Series(pd.Categorical.from_codes(dados, extra[0]))
+        else:
+            unicos, dtype = extra
+            # Código -1 (ausente) cai no None do fim
+            colunas[nome] = pd.Series(np.array(unicos + [None], dtype=object)[dados]).astype(dtype)
+    return colunas
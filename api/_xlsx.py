@@ -0,0 +1,371 @@
+"""Montagem do .xlsx dos relatórios (comum às rotas)
+
+As rotas descrevem as abas como dados ({'nome', 'linhas': [(valores, estilos)], 'larguras', 'colunas'}) e
+montar_xlsx gera o pacote direto: XML de cada aba, deflate e zip. Nível de módulo porque também roda nos
+processos de trabalho (_processos).
+"""
+import os
+import io
+import json
+import re
+import zlib
+import struct
+import math
+import numbers
+import datetime
+from xml.sax.saxutils import escape, quoteattr
+
+from _processos import mapear_em_processos, diretorio_compartilhado, exportar_colunas, importar_colunas
+
+# pandas/numpy só ao renderizar (carregar_dependencias)
+pd = np = None
+
+# Estilos compartilhados das células numéricas dos relatórios (cada rota usa os que precisa)
+FORMATOS_CELULA = {
+    'moeda': '"R$" #,##0.00',
+    'percentual': '0.0%',
+    'data': 'DD/MM/YYYY'
+}
+
+# Abas renderizadas no pool de processos só a partir de um volume mínimo de linhas;
+# abaixo disso o custo de mandar as abas aos workers domina
+EXCEL_MIN_LINHAS_PARALELO = int(os.environ.get('EXCEL_MIN_LINHAS_PARALELO', '20000'))
+EXCEL_NIVEL_COMPRESSAO = int(os.environ.get('EXCEL_NIVEL_COMPRESSAO', '6'))
+
+def carregar_dependencias():
+    """Importa pandas/numpy na primeira vez que são necessários (idempotente)"""
+    global pd, np
+    if pd is None:
+        import numpy
+        import pandas
+        np, pd = numpy, pandas
+
+# Índice de cada estilo compartilhado em cellXfs (0 = célula sem formatação)
+XF_ESTILOS = {nome: indice for indice, nome in enumerate(FORMATOS_CELULA, 1)}
+EPOCA_EXCEL = datetime.datetime(1899, 12, 30)
+CARACTERES_INVALIDOS_XML = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+CARACTERES_INVALIDOS_ABA = re.compile(r'[\[\]:*?/\\]')
+NS_PLANILHA = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+NS_RELACOES = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+NS_PACOTE = 'http://schemas.openxmlformats.org/package/2006'
+CABECALHO_XML = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+def letra_coluna(numero):
+    """Converte índice de coluna (1 = A) na letra usada nas referências"""
+    letras = ''
+    while numero:
+        numero, resto = divmod(numero - 1, 26)
+        letras = chr(65 + resto) + letras
+    return letras
+
+def numero_coluna(letras):
+    """Converte a letra da coluna (A = 1) no índice"""
+    numero = 0
+    for letra in letras.upper():
+        numero = numero * 26 + ord(letra) - 64
+    return numero
+
+def xml_celula(referencia, valor, estilo):
+    """Serializa uma célula; None, vazio e NaN não geram célula"""
+    atributo_estilo = f' s="{estilo}"' if estilo else ''
+    if valor is None or isinstance(valor, str) and not valor:
+        return ''
+    if isinstance(valor, (bool, np.bool_)):
+        return f'<c r="{referencia}" t="b"{atributo_estilo}><v>{int(valor)}</v></c>'
+    if isinstance(valor, numbers.Integral):
+        return f'<c r="{referencia}"{atributo_estilo}><v>{int(valor)}</v></c>'
+    if isinstance(valor, numbers.Real):
+        valor = float(valor)
+        if not math.isfinite(valor):
+            return ''
+        return f'<c r="{referencia}"{atributo_estilo}><v>{valor:.16g}</v></c>'
+    if isinstance(valor, datetime.date):
+        if not isinstance(valor, datetime.datetime):
+            valor = datetime.datetime.combine(valor, datetime.time())
+        serial = (valor.replace(tzinfo=None) - EPOCA_EXCEL).total_seconds() / 86400
+        return f'<c r="{referencia}"{atributo_estilo}><v>{serial:.16g}</v></c>'
+    texto = escape(CARACTERES_INVALIDOS_XML.sub('', str(valor)))
+    return f'<c r="{referencia}" t="inlineStr"{atributo_estilo}><is><t xml:space="preserve">{texto}</t></is></c>'
+
+def renderizar_aba(aba):
+    """Gera o XML de uma aba a partir de {'linhas': [(valores, estilos)], 'larguras': {letra: largura}}"""
+    partes = [CABECALHO_XML, f'<worksheet xmlns="{NS_PLANILHA}">']
+    larguras = aba.get('larguras') or {}
+    if larguras:
+        partes.append('<cols>')
+        for letra in sorted(larguras, key=numero_coluna):
+            numero = numero_coluna(letra)
+            partes.append(f'<col min="{numero}" max="{numero}" width="{larguras[letra]}" customWidth="1"/>')
+        partes.append('</cols>')
+    partes.append('<sheetData>')
+    letras = []
+    for numero, (valores, estilos) in enumerate(aba['linhas'], 1):
+        while len(letras) < len(valores):
+            letras.append(letra_coluna(len(letras) + 1))
+        estilos = estilos or {}
+        celulas = ''.join(
+            xml_celula(f'{letras[coluna - 1]}{numero}', valor, XF_ESTILOS.get(estilos.get(coluna), 0))
+            for coluna, valor in enumerate(valores, 1)
+        )
+        if celulas:
+            partes.append(f'<row r="{numero}">{celulas}</row>')
+    if aba.get('colunas'):
+        colunas, estilos = aba['colunas']
+        partes.append(xml_colunas(colunas, estilos, len(aba['linhas']) + 1))
+    partes.append('</sheetData></worksheet>')
+    return ''.join(partes).encode('utf-8')
+
+def conteudo_coluna(valores):
+    """Conteúdo XML de uma coluna inteira: (textos, vazios, é_texto); textos repetidos são escapados uma única vez"""
+    serie = pd.Series(valores)
+    if serie.dtype.kind in 'iu':
+        return serie.astype(str).to_numpy(dtype=object), np.zeros(len(serie), dtype=bool), False
+    if serie.dtype.kind == 'f':
+        numeros = serie.to_numpy(dtype=np.float64)
+        return np.array([f'{valor:.16g}' for valor in numeros.tolist()], dtype=object), ~np.isfinite(numeros), False
+    codigos, unicos = pd.factorize(serie)
+    unicos = [str(valor) for valor in unicos]
+    textos = np.array([escape(CARACTERES_INVALIDOS_XML.sub('', valor)) for valor in unicos] + [''], dtype=object)
+    vazios = np.array([not valor for valor in unicos] + [True])
+    return textos[codigos], vazios[codigos], True
+
+def xml_colunas(colunas, estilos, primeira_linha):
+    """Linhas <row> de um bloco colunar, montadas por concatenação vetorizada (mesma saída de xml_celula célula a célula)"""
+    if not colunas or not len(colunas[0]):
+        return ''
+    estilos = estilos or {}
+    numeros = np.arange(primeira_linha, primeira_linha + len(colunas[0])).astype(str).astype(object)
+    linhas = '<row r="' + numeros + '">'
+    preenchidas = np.zeros(len(numeros), dtype=bool)
+    for coluna, valores in enumerate(colunas, 1):
+        textos, vazios, texto = conteudo_coluna(valores)
+        estilo = XF_ESTILOS.get(estilos.get(coluna), 0)
+        atributo_estilo = f' s="{estilo}"' if estilo else ''
+        if texto:
+            abertura, fechamento = f'" t="inlineStr"{atributo_estilo}><is><t xml:space="preserve">', '</t></is></c>'
+        else:
+            abertura, fechamento = f'"{atributo_estilo}><v>', '</v></c>'
+        celulas = f'<c r="{letra_coluna(coluna)}' + numeros + abertura + textos + fechamento
+        linhas = linhas + np.where(vazios, '', celulas)
+        preenchidas |= ~vazios
+    return ''.join((linhas[preenchidas] + '</row>').tolist())
+
+def total_linhas_aba(aba):
+    """Linhas da aba, somando as avulsas e as do bloco colunar"""
+    colunas = aba['colunas'][0] if aba.get('colunas') else None
+    return len(aba['linhas']) + (len(colunas[0]) if colunas else 0)
+
+def nomes_abas(abas):
+    """Nomes válidos e únicos (máx. 31 caracteres, sem []:*?/\\) na ordem das abas"""
+    nomes, usados = [], set()
+    for aba in abas:
+        base = CARACTERES_INVALIDOS_ABA.sub('-', str(aba['nome'])).strip("'")[:31] or 'Aba'
+        nome, sufixo = base, 1
+        while nome.lower() in usados:
+            sufixo += 1
+            nome = f"{base[:31 - len(str(sufixo)) - 3]} ({sufixo})"
+        usados.add(nome.lower())
+        nomes.append(nome)
+    return nomes
+
+def xml_estilos():
+    """styles.xml com um registro por estilo compartilhado (cada célula só referencia o índice)"""
+    formatos = ''.join(
+        f'<numFmt numFmtId="{163 + indice}" formatCode={quoteattr(FORMATOS_CELULA[nome])}/>'
+        for nome, indice in XF_ESTILOS.items()
+    )
+    registros = ''.join(
+        f'<xf numFmtId="{163 + indice}" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+        for indice in XF_ESTILOS.values()
+    )
+    return (
+        f'{CABECALHO_XML}<styleSheet xmlns="{NS_PLANILHA}">'
+        f'<numFmts count="{len(XF_ESTILOS)}">{formatos}</numFmts>'
+        '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        f'<cellXfs count="{len(XF_ESTILOS) + 1}"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>{registros}</cellXfs>'
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        '</styleSheet>'
+    )
+
+def compactar_parte(conteudo):
+    """Comprime uma parte do pacote (deflate cru, como no zip): (crc32, tamanho original, dados)"""
+    if isinstance(conteudo, str):
+        conteudo = conteudo.encode('utf-8')
+    compressor = zlib.compressobj(EXCEL_NIVEL_COMPRESSAO, zlib.DEFLATED, -15)
+    return zlib.crc32(conteudo), len(conteudo), compressor.compress(conteudo) + compressor.flush()
+
+def compactar_aba(aba):
+    """Renderiza e comprime uma aba; unidade de trabalho dos processos paralelos"""
+    carregar_dependencias()
+    if aba.get('compartilhada'):
+        # Bloco colunar chegou como descritor: colunas mapeadas do diretório compartilhado
+        descritor, estilos = aba['colunas']
+        aba = {**aba, 'colunas': (list(importar_colunas(descritor, texto_como_categoria=True).values()), estilos)}
+    return compactar_parte(renderizar_aba(aba))
+
+def compactar_abas(abas, paralelo=True):
+    """Abas renderizadas e comprimidas no pool de processos (mesma ordem da entrada); em série se pequeno"""
+    paralelo = paralelo and sum(total_linhas_aba(aba) for aba in abas) >= EXCEL_MIN_LINHAS_PARALELO
+    if paralelo and len(abas) > 1 and any(aba.get('colunas') for aba in abas):
+        # Blocos colunares (Dados Brutos) vão aos workers por arquivos mapeados, não pelo pickle
+        with diretorio_compartilhado() as diretorio:
+            abas = [exportar_aba(aba, diretorio, f'aba{numero}') for numero, aba in enumerate(abas)]
+            return mapear_em_processos(compactar_aba, abas, paralelo)
+    return mapear_em_processos(compactar_aba, abas, paralelo)
+
+def exportar_aba(aba, diretorio, prefixo):
+    """Aba com o bloco colunar trocado pelo descritor dos arquivos compartilhados (abas sem bloco ficam como estão)"""
+    if not aba.get('colunas'):
+        return aba
+    colunas, estilos = aba['colunas']
+    descritor = exportar_colunas(dict(enumerate(colunas)), diretorio, prefixo)
+    return {**aba, 'colunas': (descritor, estilos), 'compartilhada': True}
+
+def escrever_zip(partes):
+    """Grava o zip a partir de partes já comprimidas [(nome, (crc, tamanho, dados))], com data fixa (saída determinística)"""
+    buffer = io.BytesIO()
+    central = []
+    for nome, (crc, tamanho, dados) in partes:
+        nome = nome.encode('utf-8')
+        posicao = buffer.tell()
+        # assinatura, versão, flags, método (8 = deflate), hora, data (1980-01-01), crc, tamanhos, nome, extra
+        campos = (20, 0, 8, 0, 33, crc, len(dados), tamanho, len(nome))
+        buffer.write(struct.pack('<IHHHHHIIIHH', 0x04034b50, *campos, 0))
+        buffer.write(nome)
+        buffer.write(dados)
+        central.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, *campos, 0, 0, 0, 0, 0, posicao) + nome)
+    inicio_central = buffer.tell()
+    for registro in central:
+        buffer.write(registro)
+    tamanho_central = buffer.tell() - inicio_central
+    buffer.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(central), len(central), tamanho_central, inicio_central, 0))
+    return buffer.getvalue()
+
+def montar_xlsx(abas, paralelo=True):
+    """Monta o .xlsx em uma passada: abas renderizadas e comprimidas (em paralelo), depois concatenadas no zip em ordem"""
+    nomes = nomes_abas(abas)
+    compactadas = compactar_abas(abas, paralelo)
+    
+    tipos_abas = ''.join(
+        f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        for i in range(1, len(abas) + 1)
+    )
+    lista_abas = ''.join(
+        f'<sheet name={quoteattr(nome)} sheetId="{i}" r:id="rId{i}"/>' for i, nome in enumerate(nomes, 1)
+    )
+    relacoes_abas = ''.join(
+        f'<Relationship Id="rId{i}" Type="{NS_RELACOES}/worksheet" Target="worksheets/sheet{i}.xml"/>'
+        for i in range(1, len(abas) + 1)
+    )
+    
+    partes = [
+        ('[Content_Types].xml', (
+            f'{CABECALHO_XML}<Types xmlns="{NS_PACOTE}/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/styles.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+            f'{tipos_abas}</Types>'
+        )),
+        ('_rels/.rels', (
+            f'{CABECALHO_XML}<Relationships xmlns="{NS_PACOTE}/relationships">'
+            f'<Relationship Id="rId1" Type="{NS_RELACOES}/officeDocument" Target="xl/workbook.xml"/>'
+            '</Relationships>'
+        )),
+        ('xl/workbook.xml', (
+            f'{CABECALHO_XML}<workbook xmlns="{NS_PLANILHA}" xmlns:r="{NS_RELACOES}">'
+            f'<sheets>{lista_abas}</sheets></workbook>'
+        )),
+        ('xl/_rels/workbook.xml.rels', (
+            f'{CABECALHO_XML}<Relationships xmlns="{NS_PACOTE}/relationships">{relacoes_abas}'
+            f'<Relationship Id="rId{len(abas) + 1}" Type="{NS_RELACOES}/styles" Target="styles.xml"/>'
+            '</Relationships>'
+        )),
+        ('xl/styles.xml', xml_estilos()),
+    ]
+    partes = [(nome, compactar_parte(conteudo)) for nome, conteudo in partes]
+    partes += [(f'xl/worksheets/sheet{i}.xml', parte) for i, parte in enumerate(compactadas, 1)]
+    return escrever_zip(partes)
+
+def valor_json(valor):
+    """Célula em tipo JSON com a mesma saída em xml_celula; datas como {'$data': iso}"""
+    if valor is None or isinstance(valor, str):
+        return valor
+    if isinstance(valor, (bool, np.bool_)):
+        return bool(valor)
+    if isinstance(valor, numbers.Integral):
+        return int(valor)
+    if isinstance(valor, numbers.Real):
+        valor = float(valor)
+        return valor if math.isfinite(valor) else None
+    if isinstance(valor, datetime.date):
+        if pd.isna(valor):
+            return None
+        # isoformat da classe base: o Timestamp do pandas incluiria os nanossegundos
+        return {'$data': datetime.datetime.isoformat(valor) if isinstance(valor, datetime.datetime) else valor.isoformat()}
+    return str(valor)
+
+def valor_de_json(valor):
+    """Inverso de valor_json"""
+    if isinstance(valor, dict):
+        return datetime.datetime.fromisoformat(valor['$data'])
+    return valor
+
+def coluna_json(valores):
+    """Coluna do bloco colunar como lista JSON, com o tipo que conteudo_coluna distingue (inteiro, real ou texto)"""
+    serie = pd.Series(valores)
+    if serie.dtype.kind in 'iu':
+        return {'tipo': 'inteiro', 'valores': serie.tolist()}
+    if serie.dtype.kind == 'f':
+        return {'tipo': 'real', 'valores': [valor if math.isfinite(valor) else None for valor in serie.tolist()]}
+    return {'tipo': 'texto', 'valores': [None if pd.isna(valor) else str(valor) for valor in serie.tolist()]}
+
+def coluna_de_json(coluna):
+    """Inverso de coluna_json"""
+    if coluna['tipo'] == 'inteiro':
+        return pd.Series(np.array(coluna['valores'], dtype=np.int64))
+    if coluna['tipo'] == 'real':
+        return pd.Series(np.array(coluna['valores'], dtype=np.float64))
+    return pd.Series(coluna['valores'], dtype=object)
+
+def estilos_de_json(estilos):
+    """Estilos por coluna com as chaves de volta a int (o JSON só tem chaves texto)"""
+    return {int(coluna): nome for coluna, nome in estilos.items()} if estilos else None
+
+def serializar_abas(abas):
+    """Descrição das abas em JSON (Excel adiado no cache: só dados, nada executável como no pickle)"""
+    carregar_dependencias()
+    saida = []
+    for aba in abas:
+        item = {
+            'nome': aba['nome'],
+            'linhas': [[[valor_json(valor) for valor in valores], estilos] for valores, estilos in aba['linhas']],
+            'larguras': aba.get('larguras') or {}
+        }
+        if aba.get('colunas'):
+            colunas, estilos = aba['colunas']
+            item['colunas'] = {'dados': [coluna_json(coluna) for coluna in colunas], 'estilos': estilos}
+        saida.append(item)
+    return json.dumps(saida, ensure_ascii=False).encode('utf-8')
+
+def desserializar_abas(conteudo):
+    """Abas de serializar_abas, prontas para montar_xlsx; ValueError/KeyError/TypeError se o conteúdo não for válido"""
+    carregar_dependencias()
+    abas = []
+    for item in json.loads(conteudo):
+        aba = {
+            'nome': item['nome'],
+            'linhas': [([valor_de_json(valor) for valor in valores], estilos_de_json(estilos)) for valores, estilos in item['linhas']],
+            'larguras': dict(item['larguras'])
+        }
+        if item.get('colunas'):
+            colunas = item['colunas']
+            aba['colunas'] = ([coluna_de_json(coluna) for coluna in colunas['dados']], estilos_de_json(colunas['estilos']))
+        abas.append(aba)
+    return abas
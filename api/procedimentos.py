@@ -1,13 +1,101 @@
-from http.server import BaseHTTPRequestHandler
 import json
-import pandas as pd
+import logging
+import sys
+import os
+import importlib.util
 import io
 import base64
-import openpyxl
+import multiprocessing
+import time
 import traceback
 import re # Importar a biblioteca re para expressões regulares
+from urllib.parse import urlparse, parse_qs
 
-class handler(BaseHTTPRequestHandler):
+# pandas/numpy são importados só quando uma rota precisa deles (carregar_dependencias):
+# health check e OPTIONS respondem no cold start sem pagar esse custo
+pd = np = None
+
+# Texto em Arrow quando disponível (menos memória que objetos Python); só verifica, o pandas importa quando usar
+DTYPE_TEXTO = 'string[pyarrow]' if importlib.util.find_spec('pyarrow') else 'string'
+
+def carregar_dependencias():
+    """Importa pandas/numpy na primeira vez que são necessários (idempotente)"""
+    global pd, np
+    if pd is None:
+        import numpy
+        import pandas
+        np, pd = numpy, pandas
+
+# Infraestrutura comum às rotas (api/_comum.py; o prefixo _ o mantém fora das funções da Vercel)
+DIRETORIO_API = os.path.dirname(os.path.abspath(__file__))
+if DIRETORIO_API not in sys.path:
+    sys.path.insert(0, DIRETORIO_API)
+from _comum import HandlerBase, registrador, versao_codigo, env_fatores, VALORES_VERDADEIROS, UPLOAD_MAX_BYTES, EM_MEMORIA_MAX_BYTES
+from _xlsx import montar_xlsx
+
+# Log estruturado (JSON por linha, em fila) no logger da rota
+log = logging.getLogger('api.procedimentos')
+registrar = registrador(log)
+
+# Schema normalizado dos procedimentos
+COLUNAS_PROCEDIMENTOS = ['Unidade', 'Procedimento', 'TotalItem']
+
+# Mapeamentos específicos (palavra no procedimento -> categoria), testados antes das categorias da planilha
+MAPEAMENTOS_PROCEDIMENTOS = (
+    ('CONSULTA', 'CONSULTAS'),
+    ('EXAM', 'EXAMES'),
+    ('ULTRA', 'EXAMES'),
+    ('RAIO', 'EXAMES'),
+    ('VITAMINA', 'MEDICAMENTOS'),
+    ('MEDICAMENTO', 'MEDICAMENTOS'),
+    ('REMEDIO', 'MEDICAMENTOS'),
+    ('FARMACIA', 'MEDICAMENTOS'),
+    ('DROGA', 'MEDICAMENTOS'),
+    ('COMPRIMIDO', 'MEDICAMENTOS'),
+    ('INJECAO', 'MEDICAMENTOS'),
+    ('VACINA', 'MEDICAMENTOS'),
+    ('CIRURGIA', 'PROCEDIMENTOS'),
+    ('TERAPIA', 'PROCEDIMENTOS'),
+    ('FISIOTERAPIA', 'PROCEDIMENTOS')
+)
+
+# Opções de requisição (form field ou query string)
+CENTAVOS_PADRAO = os.environ.get('PROCEDIMENTOS_CENTAVOS', '0').lower() in VALORES_VERDADEIROS
+
+# Resposta progressiva (NDJSON): seção -> campo de detalhe de cada entrada, e campos que já vão em eventos próprios
+SECOES_DETALHES = {'categorias': 'procedimentos', 'procedimentos': 'unidades', 'unidades': 'categorias'}
+CAMPOS_EVENTOS = {'estatisticas', 'excel_file', 'excel_url', *SECOES_DETALHES}
+
+# Limite de linhas por aba (o do Excel é 1.048.576); a aba "Dados Brutos" que passar dele
+# é dividida em várias abas ('dividir') ou cortada com aviso ('truncar')
+EXCEL_MAX_LINHAS_ABA = int(os.environ.get('EXCEL_MAX_LINHAS_ABA', '1048576'))
+EXCEL_DADOS_BRUTOS_EXCEDENTE = os.environ.get('EXCEL_DADOS_BRUTOS_EXCEDENTE', 'dividir')
+
+# Formatos de exportação: Excel e colunares (Parquet/Arrow IPC, exigem pyarrow)
+FORMATOS_EXPORTACAO = ('xlsx', 'parquet', 'arrow')
+
+# Cache de resultados (_comum): nome do Excel baixado no modo adiar e versão do código (rota + módulos comuns)
+NOME_DOWNLOAD_EXCEL = 'Analise_Procedimentos.xlsx'
+VERSAO_CODIGO = versao_codigo(__file__)
+
+# Planilha de categorias padrão lida do disco (usada quando a requisição não envia uma), guardada no processo
+CATEGORIAS_PADRAO_ARQUIVO = os.environ.get('PROCEDIMENTOS_CATEGORIAS_PADRAO', '')
+PRECARREGADO = {}
+
+# Multiplicador de memória por formato de upload no controle de admissão (orçamento único em _comum)
+FATORES_MEMORIA = env_fatores('PROCEDIMENTOS_FATORES_MEMORIA', {'csv': 20, 'xls': 30, 'xlsx': 100})
+
+# Aquecimento na importação (API_AQUECER=1) para servidores persistentes; no modo por requisição fica desligado
+AQUECER_NA_IMPORTACAO = os.environ.get('API_AQUECER', '0').lower() in VALORES_VERDADEIROS
+
+class handler(HandlerBase):
+    registrar = staticmethod(registrar)
+    CAMPOS_EVENTOS = CAMPOS_EVENTOS
+    ROTA = 'procedimentos'
+    NOME_DOWNLOAD_EXCEL = NOME_DOWNLOAD_EXCEL
+    VERSAO_CODIGO = VERSAO_CODIGO
+    FATORES_MEMORIA = FATORES_MEMORIA
+    
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
@@ -16,148 +104,247 @@ class handler(BaseHTTPRequestHandler):
         self.end_headers()
     
     def do_GET(self):
+        self.iniciar_requisicao()
+        # Download do Excel adiado: /api/procedimentos?excel=<chave>
+        parametros = parse_qs(urlparse(self.path).query)
+        if 'excel' in parametros:
+            carregar_dependencias()
+            self.enviar_excel(parametros['excel'][0])
+            return
+        
         self.send_response(200)
         self.send_header('Content-Type', 'application/json')
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_header()
+        self.end_headers()
         
         response = {'status': 'OK', 'message': 'API de Procedimentos funcionando!'}
         self.wfile.write(json.dumps(response).encode())
     
     def do_POST(self):
+        self.iniciar_requisicao()
         try:
-            print("=== INICIANDO PROCESSAMENTO PROCEDIMENTOS ===")
-            
+            # Limite do upload pelo Content-Length, antes de ler o corpo
             content_length = int(self.headers.get('Content-Length', 0))
-            post_data = self.rfile.read(content_length)
-            print(f"Dados recebidos: {len(post_data)} bytes")
+            self.bytes_pendentes = content_length
+            if content_length > UPLOAD_MAX_BYTES:
+                self.recusar(413, f"Upload de {content_length / 1024 / 1024:.0f} MB excede o limite de {UPLOAD_MAX_BYTES / 1024 / 1024:.0f} MB",
+                             bytes_upload=content_length)
+                return
             
-            content_type = self.headers.get('Content-Type', '')
-            if 'boundary=' not in content_type:
-                raise Exception("Content-Type inválido - boundary não encontrado")
+            # Durante o parse o corpo e as partes do multipart ficam em memória juntos
+            if not self.admitir(2 * content_length):
+                return
             
-            boundary = content_type.split('boundary=')[1]
-            print(f"Boundary: {boundary}")
+            carregar_dependencias()
             
-            files, form_data = self.parse_multipart(post_data, boundary)
-            print(f"Arquivos encontrados: {list(files.keys())}")
+            with self.etapa('leitura'):
+                post_data = self.rfile.read(content_length)
+                self.bytes_pendentes = 0
+                
+                content_type = self.headers.get('Content-Type', '')
+                if 'boundary=' not in content_type:
+                    raise Exception("Content-Type inválido - boundary não encontrado")
+                
+                boundary = content_type.split('boundary=')[1]
+                files, form_data = self.parse_multipart(post_data, boundary)
+                # As partes são cópias: o corpo já pode ser liberado
+                del post_data
+            
+            # Reserva pelo custo estimado do processamento (tamanho e formato de cada arquivo);
+            # procedimentos não têm leitura em blocos: acima do limite em memória a requisição é recusada
+            estimativa = self.estimar_memoria(files)
+            if estimativa >= EM_MEMORIA_MAX_BYTES:
+                self.recusar(413, f"Requisição estimada em {estimativa / 1024 / 1024:.0f} MB de memória excede o limite de "
+                                  f"{EM_MEMORIA_MAX_BYTES / 1024 / 1024:.0f} MB para processamento em memória "
+                                  "(planilhas de procedimentos não são lidas em blocos): divida a planilha em partes menores",
+                             memoria_estimada=estimativa)
+                return
+            if not self.admitir(estimativa):
+                return
             
             procedures_data = files.get('procedures_file')
-            categories_data = files.get('categories_file')
+            categories_data = files.get('categories_file') or self.planilha_categorias_padrao()
             
             if not procedures_data or not categories_data:
                 raise Exception("Arquivos necessários não foram enviados")
             
-            print(f"Procedures: {len(procedures_data)} bytes")
-            print(f"Categories: {len(categories_data)} bytes")
-            
-            # Processar Categorias
-            print("Processando categorias...")
-            categorias = self.processar_arquivo_categorias(categories_data)
-            print(f"Categorias encontradas: {len(categorias)}")
-            
-            # Processar Procedimentos (incluindo gratuitos)
-            print("Processando procedimentos (incluindo gratuitos)...")
-            df = self.processar_arquivo_procedimentos(procedures_data)
-            print(f"Linhas processadas: {len(df)}")
+            registrar(logging.INFO, 'processamento iniciado', rota='procedimentos', arquivos=sorted(files),
+                      bytes_procedimentos=len(procedures_data), bytes_categorias=len(categories_data),
+                      memoria_estimada_mb=round(estimativa / 1024 / 1024, 1))
             
-            # Categorizar
-            print("Categorizando procedimentos...")
-            df['Categoria'] = df['Procedimento'].apply(lambda x: self.mapear_procedimento_para_categoria(x, categorias))
+            opcoes = {
+                'centavos': self.opcao_ativa(form_data, 'centavos', CENTAVOS_PADRAO),
+                'formatos': self.opcao_formatos(form_data)
+            }
+            opcoes['modo_excel'] = self.opcao_modo_excel(form_data, opcoes['formatos'])
+            progressivo = self.opcao_progressiva(form_data)
+            
+            # Reenvio do mesmo par de arquivos: responder do cache
+            chave_cache = self.chave_cache(procedures_data, categories_data, opcoes={
+                'centavos': opcoes['centavos'],
+                'formatos': opcoes['formatos']
+            })
+            with self.etapa('cache'):
+                resposta_cache = self.ler_cache(chave_cache, opcoes['modo_excel'])
+            if resposta_cache is not None:
+                if progressivo:
+                    self.enviar_eventos(self.eventos_resposta(resposta_cache), cabecalhos={'X-Cache': 'HIT'})
+                else:
+                    self.enviar_json(resposta_cache, cabecalhos={'X-Cache': 'HIT'})
+                self.concluir_requisicao(cache='HIT', progressivo=progressivo)
+                return
+            
+            # Modo progressivo: cada etapa vira uma linha NDJSON assim que termina
+            etapas = self.executar_etapas(procedures_data, categories_data, opcoes, chave_cache, progressivo)
+            if progressivo:
+                self.enviar_eventos(etapas, cabecalhos={'X-Cache': 'MISS'})
+            else:
+                resposta = self.resposta_das_etapas(etapas)
+                with self.etapa('envio'):
+                    self.enviar_json(resposta, cabecalhos={'X-Cache': 'MISS'})
+            self.concluir_requisicao(cache='MISS', progressivo=progressivo)
             
-            # Separar estatísticas
-            procedimentos_pagos = df[df['TotalItem'] > 0]
-            procedimentos_gratuitos = df[df['TotalItem'] == 0]
+        except Exception as e:
+            # Traceback formatado uma vez: vai no log e na resposta
+            detalhes = traceback.format_exc()
+            registrar(logging.ERROR, 'falha no processamento', erro=str(e), traceback=detalhes, etapas=self.tempos_etapas)
             
-            print(f"Total procedimentos: {len(df)} registros")
-            print(f"Procedimentos pagos: {len(procedimentos_pagos)}")
-            print(f"Procedimentos gratuitos: {len(procedimentos_gratuitos)}")
+            error_response = {
+                'success': False, 
+                'error': str(e),
+                'traceback': detalhes
+            }
+            self.enviar_json(error_response, status=500)
+        finally:
+            self.liberar_memoria()
+
+    def executar_etapas(self, procedures_data, categories_data, opcoes, chave_cache, progressivo=False):
+        """Pipeline do POST como gerador de eventos (um por etapa concluída); devolve a resposta completa"""
+        # Processar Categorias
+        with self.etapa('categorias'):
+            categorias = self.processar_arquivo_categorias(categories_data)
+        
+        # Processar Procedimentos (incluindo gratuitos)
+        with self.etapa('procedimentos'):
+            df = self.processar_arquivo_procedimentos(procedures_data, centavos=opcoes['centavos'])
+        
+        # Contagem e valor total já saem do parse; o restante vai com os agregados
+        if progressivo:
+            coluna = self.coluna_valor(df)
+            yield {
+                'tipo': 'estatisticas',
+                'parcial': True,
+                'estatisticas': {
+                    'total_procedimentos': len(df),
+                    'valor_total': self.valor_em_reais(df[coluna].sum(), coluna),
+                    'valores_em_centavos': coluna == 'Centavos'
+                }
+            }
+        
+        # Categorizar
+        with self.etapa('categorizacao'):
+            df['Categoria'] = self.categorizar_procedimentos(df, categorias)
+        
+        with self.etapa('agregados'):
+            # Cubo (Unidade, Categoria, Procedimento) calculado uma vez; todas as visões saem dele por rollup
+            # Em modo centavos as somas são inteiras e só viram reais no final
+            coluna = self.coluna_valor(df)
+            cubo = self.montar_cubo(df, coluna)
+            valor_total = cubo['total'].sum()
+            procedimentos_pagos = int(cubo['pagos'].sum())
+            procedimentos_gratuitos = int(cubo['gratuitos'].sum())
             
             # Agrupar resultados GERAIS (todos os procedimentos)
-            print("Agrupando resultados gerais...")
-            resultados_gerais = df.groupby('Categoria').agg({
-                'TotalItem': ['sum', 'count']
-            }).reset_index()
-            resultados_gerais.columns = ['categoria', 'total', 'quantidade']
-            valor_total = df['TotalItem'].sum()
+            resultados_gerais = self.rollup_cubo(cubo, ['Categoria'])
+            resultados_gerais = resultados_gerais.rename(columns={'Categoria': 'categoria'})[['categoria', 'total', 'quantidade']]
             
             if valor_total > 0:
                 resultados_gerais['percentual'] = (resultados_gerais['total'] / valor_total) * 100
             else:
                 resultados_gerais['percentual'] = 0
-            resultados_gerais = resultados_gerais.sort_values('total', ascending=False)
+            resultados_gerais = self.totais_em_reais(resultados_gerais, coluna).sort_values('total', ascending=False)
             
-            # Agrupar resultados por PROCEDIMENTO
-            print("Agrupando resultados por procedimento...")
-            resultados_procedimentos = df.groupby('Procedimento').agg({
-                'TotalItem': ['sum', 'count'],
-                'Categoria': 'first'
-            }).reset_index()
-            resultados_procedimentos.columns = ['procedimento', 'total', 'quantidade', 'categoria']
-            resultados_procedimentos = resultados_procedimentos.sort_values('total', ascending=False)
+            # Agrupar resultados por PROCEDIMENTO (cada procedimento tem uma única categoria)
+            resultados_procedimentos = self.rollup_cubo(cubo, ['Procedimento', 'Categoria'])
+            resultados_procedimentos = resultados_procedimentos.rename(columns={
+                'Procedimento': 'procedimento', 'Categoria': 'categoria'
+            })[['procedimento', 'total', 'quantidade', 'categoria']]
+            resultados_procedimentos = self.totais_em_reais(resultados_procedimentos, coluna).sort_values('total', ascending=False)
             
             # Agrupar resultados por UNIDADE
-            print("Agrupando resultados por unidade...")
-            resultados_unidades = df.groupby('Unidade').agg({
-                'TotalItem': ['sum', 'count']
-            }).reset_index()
-            resultados_unidades.columns = ['unidade', 'total', 'quantidade']
+            resultados_unidades = self.rollup_cubo(cubo, ['Unidade'])
+            resultados_unidades = resultados_unidades.rename(columns={'Unidade': 'unidade'})[['unidade', 'total', 'quantidade']]
             if valor_total > 0:
                 resultados_unidades['percentual'] = (resultados_unidades['total'] / valor_total) * 100
             else:
                 resultados_unidades['percentual'] = 0
-            resultados_unidades = resultados_unidades.sort_values('total', ascending=False)
-            
-            # Preparar respostas detalhadas
-            print("Preparando respostas...")
-            categorias_gerais = self.preparar_categorias_detalhadas(resultados_gerais, df, 'categoria')
-            procedimentos_detalhados = self.preparar_categorias_detalhadas(resultados_procedimentos, df, 'procedimento')
-            unidades_detalhadas = self.preparar_categorias_detalhadas(resultados_unidades, df, 'unidade')
-            
-            # Gerar Excel
-            print("Gerando Excel...")
-            excel_b64 = self.gerar_excel_procedimentos(categorias_gerais, procedimentos_detalhados, unidades_detalhadas, df)
-            
-            resposta = {
-                'success': True,
-                'estatisticas': {
-                    'total_procedimentos': len(df),
-                    'total_categorias': len(resultados_gerais),
-                    'valor_total': float(valor_total),
-                    'total_unidades': len(resultados_unidades),
-                    'procedimentos_pagos': len(procedimentos_pagos),
-                    'procedimentos_gratuitos': len(procedimentos_gratuitos),
-                    'valor_total_pagos': float(procedimentos_pagos['TotalItem'].sum() if len(procedimentos_pagos) > 0 else 0)
-                },
-                'categorias': categorias_gerais,
-                'procedimentos': procedimentos_detalhados,
-                'unidades': unidades_detalhadas,
-                'excel_file': excel_b64
-            }
-            
-            print("Enviando resposta...")
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps(resposta).encode())
-            print("=== PROCESSAMENTO CONCLUÍDO ===")
-            
-        except Exception as e:
-            print(f"ERRO: {str(e)}")
-            print(f"Traceback: {traceback.format_exc()}")
-            
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            error_response = {
-                'success': False, 
-                'error': str(e),
-                'traceback': traceback.format_exc()
+            resultados_unidades = self.totais_em_reais(resultados_unidades, coluna).sort_values('total', ascending=False)
+        
+        # Preparar respostas detalhadas
+        with self.etapa('detalhes'):
+            categorias_gerais = self.preparar_categorias_detalhadas(resultados_gerais, cubo, 'categoria', coluna)
+            procedimentos_detalhados = self.preparar_categorias_detalhadas(resultados_procedimentos, cubo, 'procedimento', coluna)
+            unidades_detalhadas = self.preparar_categorias_detalhadas(resultados_unidades, cubo, 'unidade', coluna)
+        
+        resposta = {
+            'success': True,
+            'estatisticas': {
+                'total_procedimentos': len(df),
+                'total_categorias': len(resultados_gerais),
+                'valor_total': self.valor_em_reais(valor_total, coluna),
+                'total_unidades': len(resultados_unidades),
+                'procedimentos_pagos': procedimentos_pagos,
+                'procedimentos_gratuitos': procedimentos_gratuitos,
+                'valor_total_pagos': self.valor_em_reais(cubo['total_pagos'].sum(), coluna),
+                'valores_em_centavos': coluna == 'Centavos',
+                'memoria': self.relatorio_memoria(df)
+            },
+            'categorias': categorias_gerais,
+            'procedimentos': procedimentos_detalhados,
+            'unidades': unidades_detalhadas
+        }
+        yield from self.eventos_resultados(resposta)
+        
+        # Gerar Excel
+        excel_b64 = excel_url = None
+        if opcoes['modo_excel'] != 'omitir':
+            with self.etapa('excel'):
+                excel_b64, excel_url = self.gerar_excel_procedimentos(
+                    categorias_gerais, procedimentos_detalhados, unidades_detalhadas, df, cubo,
+                    adiar_em=chave_cache if opcoes['modo_excel'] == 'adiar' else None
+                )
+        
+        resposta['excel_file'] = excel_b64
+        if excel_url:
+            resposta['excel_url'] = excel_url
+        
+        # Exportação colunar (tipos numéricos nativos)
+        formatos_colunares = [f for f in opcoes['formatos'] if f != 'xlsx']
+        if formatos_colunares:
+            tabelas = {
+                'procedimentos': df,
+                'categorias': resultados_gerais,
+                'resumo_procedimentos': resultados_procedimentos,
+                'unidades': resultados_unidades
             }
-            self.wfile.write(json.dumps(error_response).encode())
+            with self.etapa('colunar'):
+                resposta['arquivos_colunares'] = {formato: self.exportar_tabelas(tabelas, formato) for formato in formatos_colunares}
+        
+        with self.etapa('cache'):
+            self.gravar_cache(chave_cache, resposta)
+        yield from self.eventos_finais(resposta)
+        return resposta
+
+    def eventos_resultados(self, resposta):
+        """Estatísticas, agregado de cada entrada das seções, depois os detalhes de cada uma"""
+        yield {'tipo': 'estatisticas', 'estatisticas': resposta['estatisticas']}
+        for secao, detalhe in SECOES_DETALHES.items():
+            for indice, entrada in enumerate(resposta[secao]):
+                yield {'tipo': 'agregado', 'secao': secao, 'indice': indice,
+                       **{chave: valor for chave, valor in entrada.items() if chave != detalhe}}
+        for secao, detalhe in SECOES_DETALHES.items():
+            for indice, entrada in enumerate(resposta[secao]):
+                yield {'tipo': 'detalhe', 'secao': secao, 'indice': indice, detalhe: entrada[detalhe]}
 
     def parse_multipart(self, body, boundary):
         parts = body.split(f'--{boundary}'.encode())
@@ -187,11 +374,18 @@ class handler(BaseHTTPRequestHandler):
         
         return files, form_data
 
+    def opcao_formatos(self, form_data):
+        """Formatos de saída pedidos (ex.: 'xlsx,parquet'); padrão só o Excel"""
+        formatos = [f.strip().lower() for f in self.opcao_texto(form_data, 'formato', 'xlsx').split(',') if f.strip()]
+        invalidos = [f for f in formatos if f not in FORMATOS_EXPORTACAO]
+        if invalidos:
+            raise Exception(f"Formato inválido: {', '.join(invalidos)} (use {', '.join(FORMATOS_EXPORTACAO)})")
+        return formatos
+
     def processar_arquivo_categorias(self, categories_data):
         """Processa arquivo Excel de categorias de forma robusta"""
         try:
             df = pd.read_excel(io.BytesIO(categories_data))
-            print(f"Arquivo de categorias carregado: {df.shape}")
             
             categorias = []
             
@@ -206,7 +400,7 @@ class handler(BaseHTTPRequestHandler):
             
             # Se encontrou poucas categorias, expandir busca
             if len(categorias) < 5:
-                print("Poucas categorias encontradas, expandindo busca...")
+                registrar(logging.DEBUG, 'poucas categorias encontradas, expandindo busca', encontradas=len(categorias))
                 for col in df.columns:
                     for _, row in df.iterrows():
                         if pd.notna(row[col]):
@@ -219,31 +413,29 @@ class handler(BaseHTTPRequestHandler):
             categorias = list(set(categorias))
             categorias = [cat for cat in categorias if len(cat) > 2]
             
-            print(f"Categorias encontradas ({len(categorias)}): {categorias[:10]}...")
+            registrar(logging.DEBUG, 'planilha de categorias lida', dimensoes=list(df.shape), categorias=len(categorias), amostra=categorias[:10])
             return categorias
             
         except Exception as e:
-            print(f"Erro ao processar categorias: {e}")
+            registrar(logging.WARNING, 'falha ao ler categorias, usando as padrão', erro=str(e))
             return ["CONSULTAS", "EXAMES", "PROCEDIMENTOS", "MEDICAMENTOS", "OUTROS"]
 
-    def processar_arquivo_procedimentos(self, procedures_data):
+    def processar_arquivo_procedimentos(self, procedures_data, centavos=False):
         """Processa arquivo de procedimentos INCLUINDO valores zero (gratuitos)"""
         try:
-            print("=== PROCESSAMENTO INCLUINDO PROCEDIMENTOS GRATUITOS ===")
-            
             # Ler arquivo sem assumir cabeçalhos
             df_raw = pd.read_excel(io.BytesIO(procedures_data), header=None)
-            print(f"Arquivo carregado: {df_raw.shape}")
             
             # Detectar colunas automaticamente
             unidade_col, procedimento_col, valor_col = self.detectar_colunas(df_raw)
-            print(f"Colunas detectadas: Unidade=Col{unidade_col}, Procedimento=Col{procedimento_col}, Valor=Col{valor_col}")
+            registrar(logging.DEBUG, 'colunas detectadas', dimensoes=list(df_raw.shape),
+                      unidade=unidade_col, procedimento=procedimento_col, valor=valor_col)
             
             # Extrair dados
             dados_extraidos = []
             linhas_processadas = 0
             
-            print("Extraindo dados (incluindo gratuitos)...")
+            amostrar = log.isEnabledFor(logging.DEBUG)
             for i in range(len(df_raw)):
                 try:
                     unidade = df_raw.iloc[i, unidade_col] if unidade_col < df_raw.shape[1] else None
@@ -269,36 +461,104 @@ class handler(BaseHTTPRequestHandler):
                         })
                         linhas_processadas += 1
                         
-                        # Log primeiras linhas
-                        if linhas_processadas <= 5:
-                            status = "GRATUITO" if valor_clean == 0 else f"R$ {valor_clean:,.2f}"
-                            print(f"   Linha {i}: {procedimento_clean[:40]}... | {status}")
+                        # Amostra das primeiras linhas (só em DEBUG)
+                        if amostrar and linhas_processadas <= 5:
+                            registrar(logging.DEBUG, 'amostra de linha', linha=i, procedimento=procedimento_clean[:40], valor=valor_clean)
                 
                 except Exception as e:
-                    # print(f"Erro na linha {i}: {e}") # Descomente para depuração de linha
+                    if amostrar:
+                        registrar(logging.DEBUG, 'linha ignorada', linha=i, erro=str(e))
                     continue
             
             if len(dados_extraidos) == 0:
                 raise Exception("Nenhum dado válido encontrado")
             
-            df_final = pd.DataFrame(dados_extraidos)
+            df_final = self.normalizar_procedimentos(pd.DataFrame(dados_extraidos), centavos=centavos)
             
-            # Estatísticas finais
-            pagos = df_final[df_final['TotalItem'] > 0]
-            gratuitos = df_final[df_final['TotalItem'] == 0]
-            
-            print(f"✅ PROCESSAMENTO CONCLUÍDO:")
-            print(f"   📊 Total: {len(df_final)} procedimentos")
-            print(f"   💰 Pagos: {len(pagos)} (R$ {pagos['TotalItem'].sum():,.2f})")
-            print(f"   🆓 Gratuitos: {len(gratuitos)}")
-            print(f"   🏢 Unidades: {df_final['Unidade'].nunique()}")
+            # Estatísticas da leitura (só em DEBUG: o resumo da resposta já traz os totais)
+            if amostrar:
+                pagos = df_final[df_final['TotalItem'] > 0]
+                registrar(logging.DEBUG, 'procedimentos lidos', total=len(df_final), pagos=len(pagos),
+                          valor_pagos=float(pagos['TotalItem'].sum()), gratuitos=int((df_final['TotalItem'] == 0).sum()),
+                          unidades=int(df_final['Unidade'].nunique()))
             
             return df_final
             
         except Exception as e:
-            print(f"❌ Erro no processamento: {e}")
             raise Exception(f"Erro ao processar procedimentos: {e}")
 
+    def normalizar_procedimentos(self, df, centavos=False):
+        """Aplica o schema padrão (tipos explícitos) ao DataFrame de procedimentos"""
+        df = df.reindex(columns=COLUNAS_PROCEDIMENTOS)
+        df['Unidade'] = df['Unidade'].astype('category')
+        df['Procedimento'] = df['Procedimento'].astype(DTYPE_TEXTO)
+        df['TotalItem'] = df['TotalItem'].astype('float64')
+        
+        # Valores exatos em centavos (int64) para agregação sem deriva
+        if centavos:
+            df['Centavos'] = np.rint(df['TotalItem'].to_numpy() * 100).astype(np.int64)
+        
+        return df
+
+    def coluna_valor(self, df):
+        """Coluna usada nas somas: centavos (int64) quando disponível"""
+        return 'Centavos' if 'Centavos' in df.columns else 'TotalItem'
+
+    def totais_em_reais(self, resultados, coluna):
+        """Converte a coluna 'total' de centavos para reais (fronteira JSON/Excel)"""
+        if coluna == 'Centavos':
+            resultados['total'] = resultados['total'] / 100
+        return resultados
+
+    def valor_em_reais(self, valor, coluna):
+        """Converte uma soma da coluna de valor para reais (float)"""
+        if coluna == 'Centavos':
+            return int(valor) / 100
+        return float(valor)
+
+    def montar_cubo(self, df, coluna):
+        """Agregado único no grão (Unidade, Categoria, Procedimento): soma, quantidade, pagos/gratuitos e 1ª ocorrência"""
+        pago = (df['TotalItem'] > 0).to_numpy()
+        base = pd.DataFrame({
+            'Unidade': df['Unidade'],
+            'Categoria': df['Categoria'],
+            'Procedimento': df['Procedimento'],
+            'total': df[coluna],
+            'total_pagos': df[coluna].where(pago, 0),
+            'pagos': pago.astype(np.int64),
+            'gratuitos': (df['TotalItem'] == 0).to_numpy().astype(np.int64),
+            'ordem': np.arange(len(df))
+        })
+        # Chaves nulas ficam no cubo (contam nos totais); cada rollup as descarta como o groupby direto faria
+        return base.groupby(['Unidade', 'Categoria', 'Procedimento'], observed=True, dropna=False).agg(
+            total=('total', 'sum'),
+            quantidade=('total', 'size'),
+            pagos=('pagos', 'sum'),
+            gratuitos=('gratuitos', 'sum'),
+            total_pagos=('total_pagos', 'sum'),
+            ordem=('ordem', 'min')
+        ).reset_index()
+
+    def rollup_cubo(self, cubo, chaves):
+        """Soma o cubo nas chaves pedidas (ordenado pelas chaves; totais ainda na unidade da coluna de valor)"""
+        return cubo.groupby(chaves, observed=True).agg(
+            total=('total', 'sum'),
+            quantidade=('quantidade', 'sum'),
+            pagos=('pagos', 'sum'),
+            gratuitos=('gratuitos', 'sum'),
+            total_pagos=('total_pagos', 'sum'),
+            ordem=('ordem', 'min')
+        ).reset_index()
+
+    def relatorio_memoria(self, df):
+        """Relatório de uso de memória do DataFrame normalizado"""
+        uso = df.memory_usage(deep=True, index=False)
+        return {
+            'bytes_total': int(uso.sum()),
+            'bytes_por_coluna': {col: int(valor) for col, valor in uso.items()},
+            'dtypes': {col: str(dtype) for col, dtype in df.dtypes.items()}
+        }
+
     def detectar_colunas(self, df_raw):
         """Detecta automaticamente as colunas de Unidade, Procedimento e Valor"""
         unidade_col = None
@@ -375,71 +635,67 @@ class handler(BaseHTTPRequestHandler):
             return float(valor_clean)  # Retorna valor original (pode ser 0)
             
         except Exception as e:
-            # print(f"Erro ao converter valor '{valor}': {e}") # Descomente para depuração
+            registrar(logging.DEBUG, 'valor não convertido', valor=str(valor), erro=str(e))
             return 0.0
 
-    def mapear_procedimento_para_categoria(self, procedimento, categorias):
-        """Mapeia procedimento para categoria"""
+    def categorizar_procedimentos(self, df, categorias):
+        """Categoria de cada linha: regras compiladas uma vez e aplicadas a cada procedimento distinto"""
+        regras = self.compilar_regras(categorias)
+        por_procedimento = {
+            procedimento: self.mapear_procedimento_para_categoria(procedimento, regras)
+            for procedimento in df['Procedimento'].unique()
+        }
+        return df['Procedimento'].map(por_procedimento).astype('category')
+
+    def compilar_regras(self, categorias):
+        """Regras (palavra em maiúsculas, categoria) na ordem de teste: mapeamentos específicos, depois a planilha"""
+        return list(MAPEAMENTOS_PROCEDIMENTOS) + [(str(categoria).upper().strip(), categoria) for categoria in categorias]
+
+    def mapear_procedimento_para_categoria(self, procedimento, regras):
+        """Mapeia procedimento para categoria (primeira regra cuja palavra aparece no procedimento)"""
         if not procedimento:
             return "Outros"
         
         proc_upper = str(procedimento).upper()
-        
-        # Mapeamentos específicos
-        mapeamentos = {
-            'CONSULTA': 'CONSULTAS',
-            'EXAM': 'EXAMES',
-            'ULTRA': 'EXAMES',
-            'RAIO': 'EXAMES',
-            'VITAMINA': 'MEDICAMENTOS',
-            'MEDICAMENTO': 'MEDICAMENTOS',
-            'REMEDIO': 'MEDICAMENTOS', # Adicionado para melhor detecção de medicamentos
-            'FARMACIA': 'MEDICAMENTOS', # Adicionado para melhor detecção de medicamentos
-            'DROGA': 'MEDICAMENTOS', # Adicionado para melhor detecção de medicamentos
-            'COMPRIMIDO': 'MEDICAMENTOS', # Adicionado para melhor detecção de medicamentos
-            'INJECAO': 'MEDICAMENTOS', # Adicionado para melhor detecção de medicamentos
-            'VACINA': 'MEDICAMENTOS', # Adicionado para melhor detecção de medicamentos
-            'CIRURGIA': 'PROCEDIMENTOS',
-            'TERAPIA': 'PROCEDIMENTOS',
-            'FISIOTERAPIA': 'PROCEDIMENTOS'
-        }
-        
-        for palavra, categoria in mapeamentos.items():
+        for palavra, categoria in regras:
             if palavra in proc_upper:
                 return categoria
         
-        # Verificar categorias fornecidas
-        for categoria in categorias:
-            if str(categoria).upper().strip() in proc_upper:
-                return categoria
-        
         return "Outros"
 
-    def preparar_categorias_detalhadas(self, resultados, dataframe, tipo):
-        """Prepara dados detalhados para resposta"""
-        categorias_detalhadas = []
+    def planilha_categorias_padrao(self):
+        """Planilha de categorias padrão (PROCEDIMENTOS_CATEGORIAS_PADRAO), lida do disco uma vez; None se não configurada"""
+        if not CATEGORIAS_PADRAO_ARQUIVO:
+            return None
+        if 'categorias_padrao' not in PRECARREGADO:
+            with open(CATEGORIAS_PADRAO_ARQUIVO, 'rb') as f:
+                PRECARREGADO['categorias_padrao'] = f.read()
+        return PRECARREGADO['categorias_padrao']
+
+    def preparar_categorias_detalhadas(self, resultados, cubo, tipo, coluna):
+        """Prepara dados detalhados para resposta (sub-agregados por rollup do cubo, sem refiltrar linhas)"""
+        chave, detalhe = {
+            'categoria': ('Categoria', 'Procedimento'),
+            'procedimento': ('Procedimento', 'Unidade'),
+            'unidade': ('Unidade', 'Categoria')
+        }[tipo]
+        sub = self.totais_em_reais(self.rollup_cubo(cubo, [chave, detalhe]), coluna)
+        grupos = {valor: grupo for valor, grupo in sub.groupby(chave, observed=True, sort=False)}
+        vazio = sub.iloc[0:0]
         
+        categorias_detalhadas = []
         for _, row in resultados.iterrows():
+            grupo = grupos.get(row[tipo], vazio)
+            
             if tipo == 'categoria':
-                categoria = row['categoria']
-                itens_cat = dataframe[dataframe['Categoria'] == categoria]
-                
-                procs_categoria = itens_cat.groupby('Procedimento').agg({
-                    'TotalItem': ['sum', 'count']
-                }).reset_index()
-                procs_categoria.columns = ['procedimento', 'total', 'quantidade']
-                procs_categoria = procs_categoria.sort_values('total', ascending=False)
-                
-                procedimentos_lista = []
-                for _, proc in procs_categoria.iterrows():
-                    procedimentos_lista.append({
-                        'procedimento': proc['procedimento'],
-                        'total': float(proc['total']),
-                        'quantidade': int(proc['quantidade'])
-                    })
+                procs_categoria = grupo.sort_values('total', ascending=False)
+                procedimentos_lista = [
+                    {'procedimento': procedimento, 'total': float(total), 'quantidade': int(quantidade)}
+                    for procedimento, total, quantidade in zip(procs_categoria['Procedimento'], procs_categoria['total'], procs_categoria['quantidade'])
+                ]
                 
                 categorias_detalhadas.append({
-                    'categoria': categoria,
+                    'categoria': row['categoria'],
                     'total': float(row['total']),
                     'quantidade': int(row['quantidade']),
                     'percentual': float(row['percentual']),
@@ -447,23 +703,13 @@ class handler(BaseHTTPRequestHandler):
                 })
                 
             elif tipo == 'procedimento':
-                procedimento = row['procedimento']
-                itens_proc = dataframe[dataframe['Procedimento'] == procedimento]
-                
-                unidades_proc = itens_proc.groupby('Unidade').agg({
-                    'TotalItem': ['sum', 'count']
-                }).reset_index()
-                unidades_proc.columns = ['unidade', 'total', 'quantidade']
-                
-                unidades_dict = {}
-                for _, unidade in unidades_proc.iterrows():
-                    unidades_dict[unidade['unidade']] = {
-                        'total': float(unidade['total']),
-                        'quantidade': int(unidade['quantidade'])
-                    }
+                unidades_dict = {
+                    unidade: {'total': float(total), 'quantidade': int(quantidade)}
+                    for unidade, total, quantidade in zip(grupo['Unidade'], grupo['total'], grupo['quantidade'])
+                }
                 
                 categorias_detalhadas.append({
-                    'procedimento': procedimento,
+                    'procedimento': row['procedimento'],
                     'categoria': row['categoria'],
                     'total': float(row['total']),
                     'quantidade': int(row['quantidade']),
@@ -471,25 +717,14 @@ class handler(BaseHTTPRequestHandler):
                 })
                 
             elif tipo == 'unidade':
-                unidade = row['unidade']
-                itens_unidade = dataframe[dataframe['Unidade'] == unidade]
-                
-                cats_unidade = itens_unidade.groupby('Categoria').agg({
-                    'TotalItem': ['sum', 'count']
-                }).reset_index()
-                cats_unidade.columns = ['categoria', 'total', 'quantidade']
-                cats_unidade = cats_unidade.sort_values('total', ascending=False)
-                
-                categorias_lista = []
-                for _, cat in cats_unidade.iterrows():
-                    categorias_lista.append({
-                        'categoria': cat['categoria'],
-                        'total': float(cat['total']),
-                        'quantidade': int(cat['quantidade'])
-                    })
+                cats_unidade = grupo.sort_values('total', ascending=False)
+                categorias_lista = [
+                    {'categoria': categoria, 'total': float(total), 'quantidade': int(quantidade)}
+                    for categoria, total, quantidade in zip(cats_unidade['Categoria'], cats_unidade['total'], cats_unidade['quantidade'])
+                ]
                 
                 categorias_detalhadas.append({
-                    'unidade': unidade,
+                    'unidade': row['unidade'],
                     'total': float(row['total']),
                     'quantidade': int(row['quantidade']),
                     'percentual': float(row['percentual']),
@@ -498,173 +733,256 @@ class handler(BaseHTTPRequestHandler):
         
         return categorias_detalhadas
 
-    def gerar_excel_procedimentos(self, categorias_gerais, procedimentos_detalhados, unidades_detalhadas, df):
-        """Gera Excel completo incluindo procedimentos gratuitos, medicamentos por unidade e categorias por unidade"""
+    def exportar_tabelas(self, tabelas, formato):
+        """Serializa DataFrames em Parquet ou Arrow IPC preservando os tipos"""
         try:
-            wb = openpyxl.Workbook()
-            wb.remove(wb.active)
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise Exception(f"Exportação em {formato} requer o pacote pyarrow")
+        
+        arquivos = {}
+        for nome, tabela in tabelas.items():
+            tabela_arrow = pa.Table.from_pandas(tabela, preserve_index=False)
+            buffer = io.BytesIO()
+            if formato == 'parquet':
+                pq.write_table(tabela_arrow, buffer)
+            else:
+                with pa.ipc.new_file(buffer, tabela_arrow.schema) as escritor:
+                    escritor.write_table(tabela_arrow)
+            arquivos[nome] = base64.b64encode(buffer.getvalue()).decode()
+        return arquivos
+
+    def gerar_excel_procedimentos(self, categorias_gerais, procedimentos_detalhados, unidades_detalhadas, df, cubo, adiar_em=None):
+        """Gera Excel completo incluindo procedimentos gratuitos, medicamentos por unidade e categorias por unidade; retorna (excel_b64, excel_url)"""
+        try:
+            abas = []
+            coluna = self.coluna_valor(df)
             
             # RESUMO GERAL
-            ws_resumo = wb.create_sheet("Resumo Geral")
-            ws_resumo.append(["ANÁLISE COMPLETA DE PROCEDIMENTOS MÉDICOS (INCLUINDO GRATUITOS)"])
-            ws_resumo.append([f"Gerado em: {pd.Timestamp.now().strftime('%d/%m/%Y %H:%M')}"])
-            ws_resumo.append([])
+            ws_resumo = self.nova_aba(abas, "Resumo Geral")
+            self.adicionar_linha(ws_resumo, ["ANÁLISE COMPLETA DE PROCEDIMENTOS MÉDICOS (INCLUINDO GRATUITOS)"])
+            self.adicionar_linha(ws_resumo, [f"Gerado em: {pd.Timestamp.now().strftime('%d/%m/%Y %H:%M')}"])
+            self.adicionar_linha(ws_resumo, [])
             
-            # Estatísticas
+            # Estatísticas (do cubo de agregados)
             total_procedimentos = len(df)
-            procedimentos_pagos = len(df[df['TotalItem'] > 0])
-            procedimentos_gratuitos = len(df[df['TotalItem'] == 0])
-            valor_total = df['TotalItem'].sum()
+            procedimentos_pagos = int(cubo['pagos'].sum())
+            procedimentos_gratuitos = int(cubo['gratuitos'].sum())
+            valor_total = self.valor_em_reais(cubo['total'].sum(), coluna)
             
-            ws_resumo.append(["ESTATÍSTICAS GERAIS"])
-            ws_resumo.append(["Total de Procedimentos", total_procedimentos])
-            ws_resumo.append(["Procedimentos Pagos", procedimentos_pagos])
-            ws_resumo.append(["Procedimentos Gratuitos", procedimentos_gratuitos])
-            ws_resumo.append(["% Procedimentos Gratuitos", f"{(procedimentos_gratuitos/total_procedimentos)*100:.1f}%" if total_procedimentos > 0 else "0.0%"])
-            ws_resumo.append(["Valor Total (só pagos)", f"R$ {valor_total:,.2f}"])
-            ws_resumo.append([])
+            self.adicionar_linha(ws_resumo, ["ESTATÍSTICAS GERAIS"])
+            self.adicionar_linha(ws_resumo, ["Total de Procedimentos", total_procedimentos])
+            self.adicionar_linha(ws_resumo, ["Procedimentos Pagos", procedimentos_pagos])
+            self.adicionar_linha(ws_resumo, ["Procedimentos Gratuitos", procedimentos_gratuitos])
+            self.adicionar_linha(ws_resumo, ["% Procedimentos Gratuitos", procedimentos_gratuitos / total_procedimentos if total_procedimentos > 0 else 0], {2: 'percentual'})
+            self.adicionar_linha(ws_resumo, ["Valor Total (só pagos)", valor_total], {2: 'moeda'})
+            self.adicionar_linha(ws_resumo, [])
             
-            ws_resumo.append(["RESUMO POR CATEGORIA"])
-            ws_resumo.append(["Categoria", "Valor Total", "Quantidade", "Percentual"])
+            self.adicionar_linha(ws_resumo, ["RESUMO POR CATEGORIA"])
+            self.adicionar_linha(ws_resumo, ["Categoria", "Valor Total", "Quantidade", "Percentual"])
             
             for resultado in categorias_gerais:
-                ws_resumo.append([
+                self.adicionar_linha(ws_resumo, [
                     resultado['categoria'],
-                    f"R$ {resultado['total']:,.2f}",
+                    resultado['total'],
                     resultado['quantidade'],
-                    f"{resultado['percentual']:.1f}%"
-                ])
+                    resultado['percentual'] / 100
+                ], {2: 'moeda', 4: 'percentual'})
             
             # DADOS BRUTOS
-            ws_dados = wb.create_sheet("Dados Brutos")
-            ws_dados.append(["TODOS OS PROCEDIMENTOS (PAGOS + GRATUITOS)"])
-            ws_dados.append([])
-            ws_dados.append(["#", "Unidade", "Procedimento", "Categoria", "Valor", "Tipo"])
-            
-            for i, row in df.iterrows():
-                tipo_servico = "GRATUITO" if row['TotalItem'] == 0 else "PAGO"
-                valor_formatado = "R$ 0,00" if row['TotalItem'] == 0 else f"R$ {row['TotalItem']:,.2f}"
-                
-                ws_dados.append([
-                    i + 1,
-                    row['Unidade'],
-                    row['Procedimento'],
-                    row['Categoria'],
-                    valor_formatado,
-                    tipo_servico
-                ])
+            self.adicionar_dados_brutos(abas, df)
             
             # ESTATÍSTICAS DETALHADAS
-            ws_stats = wb.create_sheet("Estatísticas Detalhadas")
-            ws_stats.append(["ANÁLISE DETALHADA POR CATEGORIA"])
-            ws_stats.append([])
-            ws_stats.append(["Categoria", "Total", "Pagos", "Gratuitos", "% Gratuitos", "Valor"])
-            
-            for categoria in df['Categoria'].unique():
-                cat_data = df[df['Categoria'] == categoria]
-                cat_total = len(cat_data)
-                cat_pagos = len(cat_data[cat_data['TotalItem'] > 0])
-                cat_gratuitos = len(cat_data[cat_data['TotalItem'] == 0])
-                cat_valor = cat_data['TotalItem'].sum()
+            ws_stats = self.nova_aba(abas, "Estatísticas Detalhadas")
+            self.adicionar_linha(ws_stats, ["ANÁLISE DETALHADA POR CATEGORIA"])
+            self.adicionar_linha(ws_stats, [])
+            self.adicionar_linha(ws_stats, ["Categoria", "Total", "Pagos", "Gratuitos", "% Gratuitos", "Valor"])
+            
+            # Categorias na ordem em que aparecem nos dados
+            stats_categorias = self.totais_em_reais(self.rollup_cubo(cubo, ['Categoria']), coluna).sort_values('ordem')
+            for _, row in stats_categorias.iterrows():
+                cat_total = int(row['quantidade'])
+                cat_gratuitos = int(row['gratuitos'])
                 cat_perc = (cat_gratuitos / cat_total) * 100 if cat_total > 0 else 0
                 
-                ws_stats.append([
-                    categoria,
+                self.adicionar_linha(ws_stats, [
+                    row['Categoria'],
                     cat_total,
-                    cat_pagos,
+                    int(row['pagos']),
                     cat_gratuitos,
-                    f"{cat_perc:.1f}%",
-                    f"R$ {cat_valor:,.2f}"
-                ])
+                    cat_perc / 100,
+                    float(row['total'])
+                ], {5: 'percentual', 6: 'moeda'})
 
             # MEDICAMENTOS POR UNIDADE (NOVA ABA)
-            print("Gerando aba 'Medicamentos por Unidade'...")
-            ws_medicamentos_unidade = wb.create_sheet("Medicamentos por Unidade")
-            ws_medicamentos_unidade.append(["MEDICAMENTOS POR UNIDADE"])
-            ws_medicamentos_unidade.append([f"Gerado em: {pd.Timestamp.now().strftime('%d/%m/%Y %H:%M')}"])
-            ws_medicamentos_unidade.append([])
-            ws_medicamentos_unidade.append(["Unidade", "Medicamento", "Quantidade", "Valor Total"])
+            ws_medicamentos_unidade = self.nova_aba(abas, "Medicamentos por Unidade")
+            self.adicionar_linha(ws_medicamentos_unidade, ["MEDICAMENTOS POR UNIDADE"])
+            self.adicionar_linha(ws_medicamentos_unidade, [f"Gerado em: {pd.Timestamp.now().strftime('%d/%m/%Y %H:%M')}"])
+            self.adicionar_linha(ws_medicamentos_unidade, [])
+            self.adicionar_linha(ws_medicamentos_unidade, ["Unidade", "Medicamento", "Quantidade", "Valor Total"])
 
-            # Filtrar apenas medicamentos
-            df_medicamentos = df[df['Categoria'] == 'MEDICAMENTOS']
+            # Fatia de medicamentos do cubo
+            cubo_medicamentos = cubo[cubo['Categoria'] == 'MEDICAMENTOS']
 
-            if not df_medicamentos.empty:
+            if not cubo_medicamentos.empty:
                 # Agrupar por Unidade e Procedimento (Medicamento)
-                medicamentos_por_unidade = df_medicamentos.groupby(['Unidade', 'Procedimento']).agg(
-                    quantidade=('Procedimento', 'count'),
-                    valor_total=('TotalItem', 'sum')
-                ).reset_index()
+                medicamentos_por_unidade = self.totais_em_reais(self.rollup_cubo(cubo_medicamentos, ['Unidade', 'Procedimento']), coluna)
 
                 # Iterar e adicionar ao Excel
                 for _, row in medicamentos_por_unidade.iterrows():
-                    ws_medicamentos_unidade.append([
+                    self.adicionar_linha(ws_medicamentos_unidade, [
                         row['Unidade'],
                         row['Procedimento'],
                         int(row['quantidade']),
-                        f"R$ {row['valor_total']:,.2f}"
-                    ])
+                        row['total']
+                    ], {4: 'moeda'})
             else:
-                ws_medicamentos_unidade.append(["Nenhum medicamento encontrado para esta análise."])
+                self.adicionar_linha(ws_medicamentos_unidade, ["Nenhum medicamento encontrado para esta análise."])
 
             # CATEGORIAS POR UNIDADE (NOVA ABA)
-            print("Gerando aba 'Categorias por Unidade'...")
-            ws_categorias_unidade = wb.create_sheet("Categorias por Unidade")
-            ws_categorias_unidade.append(["CATEGORIAS POR UNIDADE"])
-            ws_categorias_unidade.append([f"Gerado em: {pd.Timestamp.now().strftime('%d/%m/%Y %H:%M')}"])
-            ws_categorias_unidade.append([])
-            ws_categorias_unidade.append(["Unidade", "Categoria", "Quantidade", "Valor Total"])
+            ws_categorias_unidade = self.nova_aba(abas, "Categorias por Unidade")
+            self.adicionar_linha(ws_categorias_unidade, ["CATEGORIAS POR UNIDADE"])
+            self.adicionar_linha(ws_categorias_unidade, [f"Gerado em: {pd.Timestamp.now().strftime('%d/%m/%Y %H:%M')}"])
+            self.adicionar_linha(ws_categorias_unidade, [])
+            self.adicionar_linha(ws_categorias_unidade, ["Unidade", "Categoria", "Quantidade", "Valor Total"])
 
             # Agrupar por Unidade e Categoria
-            categorias_por_unidade = df.groupby(['Unidade', 'Categoria']).agg(
-                quantidade=('Categoria', 'count'),
-                valor_total=('TotalItem', 'sum')
-            ).reset_index()
+            categorias_por_unidade = self.totais_em_reais(self.rollup_cubo(cubo, ['Unidade', 'Categoria']), coluna)
 
             # Iterar e adicionar ao Excel
             for _, row in categorias_por_unidade.iterrows():
-                ws_categorias_unidade.append([
+                self.adicionar_linha(ws_categorias_unidade, [
                     row['Unidade'],
                     row['Categoria'],
                     int(row['quantidade']),
-                    f"R$ {row['valor_total']:,.2f}"
-                ])
+                    row['total']
+                ], {4: 'moeda'})
             
             # Ajustar larguras
-            ws_resumo.column_dimensions['A'].width = 25
-            ws_resumo.column_dimensions['B'].width = 15
-            
-            ws_dados.column_dimensions['A'].width = 5
-            ws_dados.column_dimensions['B'].width = 25
-            ws_dados.column_dimensions['C'].width = 60
-            ws_dados.column_dimensions['D'].width = 20
-            ws_dados.column_dimensions['E'].width = 15
-            ws_dados.column_dimensions['F'].width = 10
-            
-            ws_stats.column_dimensions['A'].width = 25
-            ws_stats.column_dimensions['B'].width = 8
-            ws_stats.column_dimensions['C'].width = 8
-            ws_stats.column_dimensions['D'].width = 10
-            ws_stats.column_dimensions['E'].width = 12
-            ws_stats.column_dimensions['F'].width = 15
-
-            ws_medicamentos_unidade.column_dimensions['A'].width = 25
-            ws_medicamentos_unidade.column_dimensions['B'].width = 60
-            ws_medicamentos_unidade.column_dimensions['C'].width = 12
-            ws_medicamentos_unidade.column_dimensions['D'].width = 15
-
-            ws_categorias_unidade.column_dimensions['A'].width = 25
-            ws_categorias_unidade.column_dimensions['B'].width = 25
-            ws_categorias_unidade.column_dimensions['C'].width = 12
-            ws_categorias_unidade.column_dimensions['D'].width = 15
+            ws_resumo['larguras']['A'] = 25
+            ws_resumo['larguras']['B'] = 15
+            
+            ws_stats['larguras']['A'] = 25
+            ws_stats['larguras']['B'] = 8
+            ws_stats['larguras']['C'] = 8
+            ws_stats['larguras']['D'] = 10
+            ws_stats['larguras']['E'] = 12
+            ws_stats['larguras']['F'] = 15
+
+            ws_medicamentos_unidade['larguras']['A'] = 25
+            ws_medicamentos_unidade['larguras']['B'] = 60
+            ws_medicamentos_unidade['larguras']['C'] = 12
+            ws_medicamentos_unidade['larguras']['D'] = 15
+
+            ws_categorias_unidade['larguras']['A'] = 25
+            ws_categorias_unidade['larguras']['B'] = 25
+            ws_categorias_unidade['larguras']['C'] = 12
+            ws_categorias_unidade['larguras']['D'] = 15
+            
+            # Adiado: só a descrição das abas vai para o cache, o .xlsx é montado no download
+            if adiar_em:
+                registrar(logging.DEBUG, 'Excel adiado', abas=len(abas))
+                return None, self.adiar_excel(adiar_em, abas)
             
             # Salvar
-            excel_buffer = io.BytesIO()
-            wb.save(excel_buffer)
-            excel_buffer.seek(0)
+            excel_bytes = montar_xlsx(abas)
             
-            print(f"✅ Excel gerado com {len(wb.worksheets)} abas")
-            return base64.b64encode(excel_buffer.getvalue()).decode()
+            registrar(logging.DEBUG, 'Excel gerado', abas=len(abas), bytes=len(excel_bytes))
+            return base64.b64encode(excel_bytes).decode(), None
             
         except Exception as e:
-            print(f"❌ Erro ao gerar Excel: {e}")
-            return None
+            registrar(logging.ERROR, 'falha ao gerar Excel', erro=str(e), traceback=traceback.format_exc())
+            return None, None
+
+    def adicionar_dados_brutos(self, abas, df):
+        """Aba(s) "Dados Brutos" escritas em bloco a partir das colunas; divide ou trunca acima do limite de linhas por aba"""
+        colunas = [
+            pd.Series(df.index.to_numpy() + 1),
+            df['Unidade'].reset_index(drop=True),
+            df['Procedimento'].reset_index(drop=True),
+            df['Categoria'].reset_index(drop=True),
+            pd.Series(df['TotalItem'].to_numpy()),
+            pd.Series(np.where(df['TotalItem'].to_numpy() == 0, 'GRATUITO', 'PAGO'))
+        ]
+        total = len(df)
+        capacidade = max(EXCEL_MAX_LINHAS_ABA - 3, 1)
+        if total > capacidade and EXCEL_DADOS_BRUTOS_EXCEDENTE == 'truncar':
+            faixas = [(0, capacidade)]
+            avisos = [f"Exibindo {capacidade} de {total} procedimentos (limite de linhas por aba)"]
+        else:
+            faixas = [(inicio, min(inicio + capacidade, total)) for inicio in range(0, max(total, 1), capacidade)]
+            avisos = [
+                f"Parte {parte} de {len(faixas)}: procedimentos {inicio + 1} a {fim}" if len(faixas) > 1 else None
+                for parte, (inicio, fim) in enumerate(faixas, 1)
+            ]
+            if total > capacidade:
+                registrar(logging.INFO, 'Dados Brutos divididos em várias abas', linhas=total, abas=len(faixas))
+        
+        for parte, ((inicio, fim), aviso) in enumerate(zip(faixas, avisos), 1):
+            ws_dados = self.nova_aba(abas, "Dados Brutos" if parte == 1 else f"Dados Brutos ({parte})")
+            self.adicionar_linha(ws_dados, ["TODOS OS PROCEDIMENTOS (PAGOS + GRATUITOS)"])
+            self.adicionar_linha(ws_dados, [aviso] if aviso else [])
+            self.adicionar_linha(ws_dados, ["#", "Unidade", "Procedimento", "Categoria", "Valor", "Tipo"])
+            self.adicionar_colunas(ws_dados, [coluna.iloc[inicio:fim] for coluna in colunas], {5: 'moeda'})
+            
+            ws_dados['larguras']['A'] = 5
+            ws_dados['larguras']['B'] = 25
+            ws_dados['larguras']['C'] = 60
+            ws_dados['larguras']['D'] = 20
+            ws_dados['larguras']['E'] = 15
+            ws_dados['larguras']['F'] = 10
+
+
+# Planilhas sintéticas do aquecimento (procedimentos pagos e gratuitos, uma linha de cabeçalho)
+PROCEDIMENTOS_AQUECIMENTO = [
+    ['Unidade', 'Procedimento', 'TotalItem'],
+    ['UBS AQUECIMENTO', 'CONSULTA MEDICA', 50.0],
+    ['UBS AQUECIMENTO', 'DIPIRONA COMPRIMIDO', 0.0],
+    ['UPA AQUECIMENTO', 'RAIO X TORAX', 80.5],
+    ['UPA AQUECIMENTO', 'CURATIVO SIMPLES', 0.0]
+]
+CATEGORIAS_AQUECIMENTO = [['Categoria'], ['CONSULTAS'], ['EXAMES'], ['MEDICAMENTOS'], ['PROCEDIMENTOS'], ['CURATIVO']]
+
+def aquecer():
+    """Pré-carrega dependências e passa uma planilha sintética pelo pipeline (leitura, cubo, Excel); registra os tempos"""
+    inicio = time.perf_counter()
+    tempos = {}
+    
+    def marcar(etapa, desde):
+        tempos[etapa] = round((time.perf_counter() - desde) * 1000, 1)
+        return time.perf_counter()
+    
+    try:
+        t = time.perf_counter()
+        carregar_dependencias()
+        import openpyxl  # noqa: F401 (leitura das planilhas pelo pandas)
+        t = marcar('dependências', t)
+        
+        def planilha(linhas):
+            return montar_xlsx([{'nome': 'Planilha', 'linhas': [(linha, None) for linha in linhas], 'larguras': {}}], paralelo=False)
+        
+        instancia = handler.__new__(handler)
+        categorias = instancia.processar_arquivo_categorias(instancia.planilha_categorias_padrao() or planilha(CATEGORIAS_AQUECIMENTO))
+        df = instancia.processar_arquivo_procedimentos(planilha(PROCEDIMENTOS_AQUECIMENTO), centavos=CENTAVOS_PADRAO)
+        t = marcar('leitura', t)
+        
+        df['Categoria'] = instancia.categorizar_procedimentos(df, categorias)
+        coluna = instancia.coluna_valor(df)
+        cubo = instancia.montar_cubo(df, coluna)
+        resultados = instancia.totais_em_reais(instancia.rollup_cubo(cubo, ['Procedimento', 'Categoria']), coluna)
+        resultados = resultados.rename(columns={'Procedimento': 'procedimento', 'Categoria': 'categoria'})
+        procedimentos_detalhados = instancia.preparar_categorias_detalhadas(resultados, cubo, 'procedimento', coluna)
+        list(instancia.serializar_json({'procedimentos': procedimentos_detalhados}))
+        t = marcar('agregação', t)
+        
+        instancia.gerar_excel_procedimentos([], procedimentos_detalhados, [], df, cubo)
+        marcar('Excel', t)
+        
+        registrar(logging.INFO, 'aquecimento concluído', duracao_ms=round((time.perf_counter() - inicio) * 1000, 1), etapas=tempos)
+    except Exception as e:
+        # Falha no aquecimento não impede o processo de atender: a primeira requisição só paga o custo
+        registrar(logging.WARNING, 'aquecimento incompleto', duracao_ms=round((time.perf_counter() - inicio) * 1000, 1), etapas=tempos, erro=str(e))
+
+if AQUECER_NA_IMPORTACAO and multiprocessing.parent_process() is None:
+    aquecer()
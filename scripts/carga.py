@@ -0,0 +1,391 @@
+"""Gerador de carga local para /api/extratos e /api/procedimentos.
+
+Dispara uploads multipart concorrentes (extrato de exemplo em api/ e planilhas
+sintéticas) contra servidores locais iniciados pelo próprio script, ou contra
+uma URL já no ar. Registra latência p50/p95/p99, vazão, taxa de erro e o RSS
+dos processos servidores ao longo do tempo, e grava um relatório JSON que pode
+ser comparado com uma rodada anterior.
+
+Uso:
+    python scripts/carga.py --concorrencia 8 --duracao 30 --mix extratos=3,procedimentos=1 \\
+        --servidores 2 --relatorio carga.json [--comparar carga_anterior.json]
+
+    # Contra um deploy existente (RSS só com --pid)
+    python scripts/carga.py --url http://127.0.0.1:8000 --pid 1234
+
+Por padrão o cache de resultados fica desligado nos servidores locais (senão
+toda requisição depois da primeira seria um acerto de cache); use --cache para
+medir com ele.
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIRETORIO_API = os.path.join(RAIZ, 'api')
+EXTRATO_EXEMPLO = os.path.join(DIRETORIO_API, 'extrato (5).csv')
+ENDPOINTS = ('extratos', 'procedimentos')
+PERCENTIS = (50, 95, 99)
+INTERVALO_RSS = 0.5
+
+# Processo servidor: um ThreadingHTTPServer por endpoint, portas repassadas ao processo pai pela stdout
+SERVIDOR = r'''
+import json, sys, threading
+from http.server import ThreadingHTTPServer
+import extratos, procedimentos
+portas = {}
+for nome, modulo in (('extratos', extratos), ('procedimentos', procedimentos)):
+    modulo.handler.log_message = lambda *args: None
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), modulo.handler)
+    portas[nome] = servidor.server_address[1]
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+print('PORTAS ' + json.dumps(portas), flush=True)
+sys.stdin.read()
+'''
+
+
+# Entradas
+
+def extrato_sintetico(linhas, semente):
+    """CSV no formato do Banco do Brasil com descrições que exercitam as categorias"""
+    aleatorio = random.Random(semente)
+    descricoes = [
+        'Compra com Cartão - 01/08 14:47 POSTO IPIRANGA', 'Pix - Enviado MERCADO CENTRAL',
+        'Pix - Recebido CLIENTE', 'Compra com Cartão - 02/08 12:10 RESTAURANTE SABOR',
+        'Pagamento de Boleto ENERGIA', 'Compra com Cartão - 03/08 09:00 ESTACIONAMENTO CENTRO'
+    ]
+    saida = io.StringIO()
+    saida.write('"Data","Dependencia Origem","Histórico","Data do Balancete","Número do documento","Valor",\n')
+    saida.write('"31/07/2025","","Saldo Anterior","","0","0.00",\n')
+    for i in range(linhas):
+        valor = aleatorio.uniform(-800, 800) or 1.0
+        saida.write(f'"{1 + i % 28:02d}/08/2025","0001-9","{aleatorio.choice(descricoes)}","","{i + 1}","{valor:.2f}",\n')
+    return saida.getvalue().encode('latin-1')
+
+
+def planilha(linhas):
+    """.xlsx em memória (openpyxl)"""
+    from openpyxl import Workbook
+    livro = Workbook()
+    aba = livro.active
+    for linha in linhas:
+        aba.append(linha)
+    saida = io.BytesIO()
+    livro.save(saida)
+    return saida.getvalue()
+
+
+def entradas(linhas_sinteticas):
+    """Arquivos de cada endpoint (campos multipart)"""
+    categorias_extrato = planilha([
+        ['Grupo', 'Palavra-chave'], ['Combustível', 'POSTO'], ['Pix', 'PIX'],
+        ['Alimentação', 'RESTAURANTE'], ['Alimentação', 'MERCADO'], ['Estacionamento', 'ESTACIONAMENTO']
+    ])
+    extrato = extrato_sintetico(linhas_sinteticas, 0) if linhas_sinteticas else open(EXTRATO_EXEMPLO, 'rb').read()
+
+    aleatorio = random.Random(1)
+    nomes = ['CONSULTA MEDICA', 'RAIO X TORAX', 'DIPIRONA COMPRIMIDO', 'CURATIVO SIMPLES', 'FISIOTERAPIA', 'EXAME SANGUE']
+    procedimentos = planilha([['Unidade', 'Procedimento', 'TotalItem']] + [
+        [f'UBS {aleatorio.randint(1, 12)}', aleatorio.choice(nomes), aleatorio.choice([0, 0, 35.5, 80, 120.75])]
+        for _ in range(linhas_sinteticas or 500)
+    ])
+    categorias_procedimentos = planilha([['Categoria'], ['CONSULTAS'], ['EXAMES'], ['MEDICAMENTOS'], ['PROCEDIMENTOS'], ['CURATIVO']])
+    return {
+        'extratos': {'csv_file': ('extrato.csv', extrato), 'excel_file': ('categorias.xlsx', categorias_extrato)},
+        'procedimentos': {'procedures_file': ('procedimentos.xlsx', procedimentos), 'categories_file': ('categorias.xlsx', categorias_procedimentos)}
+    }
+
+
+def multipart(arquivos, campos):
+    """Corpo multipart/form-data e o boundary"""
+    boundary = uuid.uuid4().hex
+    partes = []
+    for nome, valor in campos.items():
+        partes.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{nome}"\r\n\r\n{valor}\r\n'.encode())
+    for nome, (arquivo, conteudo) in arquivos.items():
+        partes.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{nome}"; filename="{arquivo}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n'.encode() + conteudo + b'\r\n'
+        )
+    partes.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(partes), boundary
+
+
+# Servidores locais e RSS
+
+def iniciar_servidores(quantidade, cache, aquecer, diretorio):
+    """Sobe `quantidade` processos servidores isolados (cache/memo/histórico em diretório temporário)"""
+    ambiente = dict(os.environ)
+    ambiente.update({
+        'RESULT_CACHE_DIR': os.path.join(diretorio, 'cache'),
+        'EXTRATO_MEMO_DB': os.path.join(diretorio, 'memo.sqlite3'),
+        'EXTRATO_HISTORICO_DB': os.path.join(diretorio, 'historico.sqlite3'),
+        'API_AQUECER': '1' if aquecer else '0'
+    })
+    if not cache:
+        ambiente['RESULT_CACHE_MAX_MB'] = '0'
+
+    processos, urls = [], {nome: [] for nome in ENDPOINTS}
+    for _ in range(quantidade):
+        processo = subprocess.Popen(
+            [sys.executable, '-c', SERVIDOR], cwd=DIRETORIO_API, env=ambiente,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+        )
+        for linha in processo.stdout:
+            if linha.startswith('PORTAS '):
+                for nome, porta in json.loads(linha[len('PORTAS '):]).items():
+                    urls[nome].append(f'http://127.0.0.1:{porta}/api/{nome}')
+                break
+        else:
+            raise RuntimeError("Servidor local não iniciou")
+        # Logs do processamento não interessam aqui; drenar a stdout evita bloquear o servidor
+        threading.Thread(target=processo.stdout.read, daemon=True).start()
+        processos.append(processo)
+    return processos, urls
+
+
+def rss_mb(pids):
+    """RSS somado dos processos e de seus filhos (pools de workers), em MB; None fora do Linux"""
+    total = 0
+    pendentes = list(pids)
+    vistos = set()
+    while pendentes:
+        pid = pendentes.pop()
+        if pid in vistos:
+            continue
+        vistos.add(pid)
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for linha in f:
+                    if linha.startswith('VmRSS:'):
+                        total += int(linha.split()[1])
+            for tarefa in os.listdir(f'/proc/{pid}/task'):
+                with open(f'/proc/{pid}/task/{tarefa}/children') as f:
+                    pendentes.extend(int(filho) for filho in f.read().split())
+        except OSError:
+            if not os.path.exists('/proc'):
+                return None
+    return total / 1024
+
+
+# Execução
+
+def percentil(ordenados, p):
+    """Percentil por posição mais próxima sobre valores já ordenados"""
+    if not ordenados:
+        return None
+    return ordenados[min(len(ordenados) - 1, max(0, round(p / 100 * len(ordenados) + 0.5) - 1))]
+
+
+def parse_mix(texto):
+    """'extratos=3,procedimentos=1' -> {'extratos': 3.0, 'procedimentos': 1.0}"""
+    mix = {}
+    for item in texto.split(','):
+        nome, _, peso = item.partition('=')
+        nome = nome.strip()
+        if nome not in ENDPOINTS:
+            raise SystemExit(f"Endpoint desconhecido no mix: {nome} (use {', '.join(ENDPOINTS)})")
+        mix[nome] = float(peso or 1)
+    return {nome: peso for nome, peso in mix.items() if peso > 0}
+
+
+def executar(args, urls, corpos, pids):
+    """Clientes concorrentes até o fim da duração (ou do número de requisições); devolve amostras e série de RSS"""
+    amostras = []
+    trava = threading.Lock()
+    contador = itertools.count()
+    nomes, pesos = zip(*args.mix.items())
+    inicio = time.perf_counter()
+    fim = inicio + args.duracao
+    parar = threading.Event()
+
+    def cliente(numero):
+        aleatorio = random.Random(numero)
+        rodizio = {nome: itertools.cycle(urls[nome][numero % len(urls[nome]):] + urls[nome][:numero % len(urls[nome])]) for nome in nomes}
+        while not parar.is_set():
+            if args.requisicoes and next(contador) >= args.requisicoes:
+                break
+            if not args.requisicoes and time.perf_counter() >= fim:
+                break
+            nome = aleatorio.choices(nomes, pesos)[0]
+            corpo, boundary = corpos[nome]
+            requisicao = urllib.request.Request(
+                next(rodizio[nome]), data=corpo,
+                headers={'Content-Type': f'multipart/form-data; boundary={boundary}', 'Accept-Encoding': 'gzip'}
+            )
+            t = time.perf_counter()
+            try:
+                with urllib.request.urlopen(requisicao, timeout=args.timeout) as resposta:
+                    status, tamanho = resposta.status, len(resposta.read())
+            except urllib.error.HTTPError as e:
+                status, tamanho = e.code, 0
+            except Exception:
+                status, tamanho = None, 0
+            with trava:
+                amostras.append((nome, t - inicio, time.perf_counter() - t, status, tamanho))
+
+    serie_rss = []
+
+    def amostrar_rss():
+        while not parar.wait(INTERVALO_RSS):
+            valor = rss_mb(pids) if pids else None
+            if valor is not None:
+                serie_rss.append((round(time.perf_counter() - inicio, 2), round(valor, 1)))
+
+    monitor = threading.Thread(target=amostrar_rss, daemon=True)
+    monitor.start()
+    clientes = [threading.Thread(target=cliente, args=(i,)) for i in range(args.concorrencia)]
+    for thread in clientes:
+        thread.start()
+    for thread in clientes:
+        thread.join()
+    parar.set()
+    monitor.join()
+    return amostras, time.perf_counter() - inicio, serie_rss
+
+
+def resumir(amostras, duracao):
+    """Estatísticas por endpoint e total (latências em ms)"""
+    grupos = {'total': amostras}
+    for nome in ENDPOINTS:
+        grupo = [amostra for amostra in amostras if amostra[0] == nome]
+        if grupo:
+            grupos[nome] = grupo
+
+    resumo = {}
+    for nome, grupo in grupos.items():
+        latencias = sorted(amostra[2] * 1000 for amostra in grupo)
+        erros = sum(1 for amostra in grupo if amostra[3] != 200)
+        resumo[nome] = {
+            'requisicoes': len(grupo),
+            'erros': erros,
+            'taxa_erro': erros / len(grupo) if grupo else 0,
+            'vazao_rps': len(grupo) / duracao if duracao else 0,
+            'latencia_ms': {
+                **{f'p{p}': percentil(latencias, p) for p in PERCENTIS},
+                'media': sum(latencias) / len(latencias) if latencias else None,
+                'max': latencias[-1] if latencias else None
+            },
+            'bytes_resposta': sum(amostra[4] for amostra in grupo)
+        }
+    return resumo
+
+
+def imprimir(relatorio, anterior=None):
+    """Tabela do relatório (com a variação em relação a uma rodada anterior, se houver)"""
+    def variacao(atual, antigo):
+        if anterior is None or antigo in (None, 0) or atual is None:
+            return ''
+        return f" ({(atual - antigo) / antigo * 100:+.0f}%)"
+
+    print(f"\n{'endpoint':<15}{'req':>7}{'erro %':>8}{'req/s':>9}{'p50 ms':>16}{'p95 ms':>16}{'p99 ms':>16}")
+    for nome, dados in relatorio['resumo'].items():
+        antigo = (anterior or {}).get('resumo', {}).get(nome, {})
+        latencias = dados['latencia_ms']
+        colunas = [
+            f"{latencias[f'p{p}'] or 0:.0f}{variacao(latencias[f'p{p}'], antigo.get('latencia_ms', {}).get(f'p{p}'))}"
+            for p in PERCENTIS
+        ]
+        print(f"{nome:<15}{dados['requisicoes']:>7}{dados['taxa_erro'] * 100:>8.1f}"
+              f"{dados['vazao_rps']:>9.2f}{colunas[0]:>16}{colunas[1]:>16}{colunas[2]:>16}")
+    rss = relatorio['rss_mb']
+    if rss['pico'] is not None:
+        print(f"\nRSS dos servidores: inicial {rss['inicial']:.0f} MB, pico {rss['pico']:.0f} MB, final {rss['final']:.0f} MB"
+              f"{variacao(rss['pico'], (anterior or {}).get('rss_mb', {}).get('pico'))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concorrencia', type=int, default=4, help='clientes simultâneos')
+    parser.add_argument('--duracao', type=float, default=20, help='segundos de carga')
+    parser.add_argument('--requisicoes', type=int, default=0, help='total de requisições (substitui --duracao)')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('extratos=1,procedimentos=1'), help='pesos por endpoint')
+    parser.add_argument('--linhas', type=int, default=0, help='linhas dos arquivos sintéticos (0 = extrato de exemplo)')
+    parser.add_argument('--servidores', type=int, default=1, help='processos servidores locais')
+    parser.add_argument('--url', help='base de um servidor já no ar (não sobe servidores locais)')
+    parser.add_argument('--pid', type=int, action='append', default=[], help='PID do servidor externo para medir RSS')
+    parser.add_argument('--cache', action='store_true', help='mantém o cache de resultados ligado nos servidores locais')
+    parser.add_argument('--aquecer', action='store_true', help='aquecimento dos servidores locais na partida (API_AQUECER=1)')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--relatorio', help='caminho do relatório JSON')
+    parser.add_argument('--comparar', help='relatório JSON de uma rodada anterior')
+    args = parser.parse_args()
+    if not args.mix:
+        raise SystemExit("Mix vazio")
+
+    arquivos = entradas(args.linhas)
+    corpos = {nome: multipart(arquivos[nome], {}) for nome in ENDPOINTS}
+
+    with tempfile.TemporaryDirectory(prefix='carga-') as diretorio:
+        processos = []
+        try:
+            if args.url:
+                urls = {nome: [f"{args.url.rstrip('/')}/api/{nome}"] for nome in ENDPOINTS}
+                pids = args.pid
+            else:
+                print(f"Iniciando {args.servidores} servidor(es) local(is)...")
+                processos, urls = iniciar_servidores(args.servidores, args.cache, args.aquecer, diretorio)
+                pids = [processo.pid for processo in processos]
+
+            rss_inicial = rss_mb(pids) if pids else None
+            print(f"Carga: {args.concorrencia} clientes, mix {args.mix}, "
+                  f"{f'{args.requisicoes} requisições' if args.requisicoes else f'{args.duracao:.0f}s'}")
+            amostras, duracao, serie_rss = executar(args, urls, corpos, pids)
+        finally:
+            for processo in processos:
+                processo.terminate()
+                processo.wait()
+
+    valores_rss = [valor for _, valor in serie_rss]
+    relatorio = {
+        'gerado_em': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'configuracao': {
+            'concorrencia': args.concorrencia,
+            'duracao_s': round(duracao, 2),
+            'mix': args.mix,
+            'linhas': args.linhas,
+            'servidores': None if args.url else args.servidores,
+            'url': args.url,
+            'cache': args.cache,
+            'aquecer': args.aquecer,
+            'bytes_requisicao': {nome: len(corpos[nome][0]) for nome in ENDPOINTS}
+        },
+        'resumo': resumir(amostras, duracao),
+        'rss_mb': {
+            'inicial': rss_inicial,
+            'pico': max(valores_rss) if valores_rss else None,
+            'final': valores_rss[-1] if valores_rss else None,
+            'serie': serie_rss
+        },
+        # Latência ao longo do tempo: (segundos desde o início, endpoint, ms, status)
+        'amostras': [(round(t, 3), nome, round(latencia * 1000, 1), status) for nome, t, latencia, status, _ in amostras]
+    }
+
+    anterior = None
+    if args.comparar:
+        with open(args.comparar) as f:
+            anterior = json.load(f)
+    imprimir(relatorio, anterior)
+
+    if args.relatorio:
+        with open(args.relatorio, 'w') as f:
+            json.dump(relatorio, f, ensure_ascii=False, indent=1)
+        print(f"\nRelatório gravado em {args.relatorio}")
+
+    if relatorio['resumo'].get('total', {}).get('erros'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Mede o cold start das funções em api/ e falha se passar do orçamento.
+
+Cada amostra roda em um processo Python novo: importa o módulo, sobe o handler
+em uma porta local e faz o GET de health check. Verifica também que nem o
+import nem o health check carregam pandas/numpy.
+
+Uso:
+    python scripts/medir_cold_start.py [--amostras 5] [--orcamento-import-ms 250] [--orcamento-get-ms 300]
+
+Orçamentos também por ambiente: COLD_START_IMPORT_MS e COLD_START_GET_MS.
+Sai com código 1 se algum módulo estourar o orçamento (uso em CI).
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIRETORIO_API = os.path.join(RAIZ, 'api')
+MODULOS = ('extratos', 'procedimentos')
+DEPENDENCIAS_PESADAS = ('pandas', 'numpy', 'openpyxl', 'pyarrow')
+
+# Executado no processo filho: import + GET de health check, em milissegundos
+AMOSTRA = r'''
+import json, sys, threading, time
+inicio = time.perf_counter()
+import {modulo}
+importado = time.perf_counter()
+carregadas_import = [nome for nome in {pesadas!r} if nome in sys.modules]
+
+from http.server import HTTPServer
+import http.client
+{modulo}.handler.log_message = lambda *args: None
+servidor = HTTPServer(('127.0.0.1', 0), {modulo}.handler)
+threading.Thread(target=servidor.handle_request, daemon=True).start()
+antes_get = time.perf_counter()
+conexao = http.client.HTTPConnection('127.0.0.1', servidor.server_address[1])
+conexao.request('GET', '/')
+resposta = conexao.getresponse()
+resposta.read()
+fim = time.perf_counter()
+
+print(json.dumps({{
+    'import_ms': (importado - inicio) * 1000,
+    'get_ms': (fim - antes_get) * 1000,
+    'status': resposta.status,
+    'carregadas_import': carregadas_import,
+    'carregadas_get': [nome for nome in {pesadas!r} if nome in sys.modules]
+}}))
+'''
+
+
+def medir(modulo):
+    """Uma amostra em processo novo"""
+    codigo = AMOSTRA.format(modulo=modulo, pesadas=DEPENDENCIAS_PESADAS)
+    saida = subprocess.run(
+        [sys.executable, '-c', codigo], cwd=DIRETORIO_API,
+        capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(saida.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--amostras', type=int, default=5)
+    parser.add_argument('--orcamento-import-ms', type=float, default=float(os.environ.get('COLD_START_IMPORT_MS', '250')))
+    parser.add_argument('--orcamento-get-ms', type=float, default=float(os.environ.get('COLD_START_GET_MS', '300')))
+    args = parser.parse_args()
+
+    falhas = []
+    print(f"{'módulo':<15}{'import p50':>12}{'import máx':>12}{'GET p50':>10}  dependências carregadas")
+    for modulo in MODULOS:
+        amostras = [medir(modulo) for _ in range(args.amostras)]
+        import_ms = [amostra['import_ms'] for amostra in amostras]
+        get_ms = [amostra['import_ms'] + amostra['get_ms'] for amostra in amostras]
+        carregadas = sorted({nome for amostra in amostras for nome in amostra['carregadas_get']})
+        print(f"{modulo:<15}{statistics.median(import_ms):>10.1f}ms{max(import_ms):>10.1f}ms"
+              f"{statistics.median(get_ms):>8.1f}ms  {', '.join(carregadas) or '-'}")
+
+        # Mediana contra o orçamento (uma amostra lenta isolada não derruba o CI)
+        if statistics.median(import_ms) > args.orcamento_import_ms:
+            falhas.append(f"{modulo}: import {statistics.median(import_ms):.1f}ms > {args.orcamento_import_ms:.0f}ms")
+        if statistics.median(get_ms) > args.orcamento_get_ms:
+            falhas.append(f"{modulo}: import + GET {statistics.median(get_ms):.1f}ms > {args.orcamento_get_ms:.0f}ms")
+        if carregadas:
+            falhas.append(f"{modulo}: health check carregou {', '.join(carregadas)}")
+        if any(amostra['status'] != 200 for amostra in amostras):
+            falhas.append(f"{modulo}: health check não respondeu 200")
+
+    if falhas:
+        print("\nOrçamento de cold start estourado:")
+        for falha in falhas:
+            print(f"  - {falha}")
+        sys.exit(1)
+    print("\nDentro do orçamento.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Compara a categorização de extratos com o casamento por substring original (antes do índice de tokens).
+
+Categoriza o extrato de exemplo em api/ (ou outro CSV) pelos dois caminhos e lista as divergências.
+Transação que a versão original categorizava e agora cai em outra categoria é regressão: sai com código 1.
+Transação que a original deixava em Outros e agora casa (acentos, mojibake) é só listada.
+Também confere que palavras-chave curtas demais (PALAVRAS_CURTAS: 'R$' vira R, 'S/A' vira S A) são
+ignoradas: somadas às categorias, não podem mudar a categoria de nenhuma transação.
+
+Uso:
+    python scripts/verificar_categorizacao.py [--extrato "api/extrato (5).csv"] [--categorias planilha.xlsx]
+
+Sem --categorias usa as palavras-chave de CATEGORIAS_EXEMPLO, que cobrem casamentos dentro de palavras
+('MERCADO' em 'Minimercado', 'PARK' em 'MULTIPARK'), palavras-chave de vários termos e acentos.
+"""
+import argparse
+import os
+import sys
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIRETORIO_API = os.path.join(RAIZ, 'api')
+EXTRATO_EXEMPLO = os.path.join(DIRETORIO_API, 'extrato (5).csv')
+
+# Palavra-chave -> categoria, na ordem de uma planilha (empate de tamanho fica com a primeira)
+CATEGORIAS_EXEMPLO = {
+    'ESTACIONA': 'Estacionamento', 'PARK': 'Estacionamento',
+    'POSTO': 'Combustível', 'POSTO CARREFOUR': 'Combustível',
+    'MERCADO': 'Mercado', 'CARREFOUR': 'Mercado', 'ATACADAO': 'Mercado', 'VERDURAO': 'Mercado',
+    'HORTIFRUTI': 'Mercado', 'PAO DE ACUCAR': 'Mercado', 'EMPORIO': 'Mercado',
+    'PANI': 'Padaria', 'PANE': 'Padaria',
+    'Ifood': 'Alimentação', 'GELATERIA': 'Alimentação', 'BISTRO': 'Alimentação',
+    'DROGASIL': 'Saúde', 'Farm': 'Saúde', 'CLINICA': 'Saúde', 'VACINAS': 'Saúde',
+    'TELECOM': 'Telefonia', 'Energia': 'Contas', 'Impostos': 'Impostos', 'RFB': 'Impostos',
+    'Tarifa Pacote': 'Tarifas', 'Rende Fácil': 'Investimentos', 'Cartão crédito': 'Cartão',
+    'Pix - Recebido': 'Recebimentos', 'FLAMBOYANT': 'Shopping', 'KALUNGA GOIA': 'Papelaria'
+}
+
+# Só tokens de 1 caractere depois da normalização: casariam em quase toda descrição
+PALAVRAS_CURTAS = {'R$': 'Curta demais', 'S/A': 'Curta demais', 'c/c': 'Curta demais'}
+
+
+def categoria_original(descricao, palavras_ordenadas, categorias):
+    """Casamento da versão sem índice: a palavra-chave mais longa contida na descrição em maiúsculas"""
+    texto = str(descricao).upper()
+    for palavra in palavras_ordenadas:
+        if palavra.upper() in texto:
+            return categorias[palavra]
+    return 'Outros'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--extrato', default=EXTRATO_EXEMPLO, help='CSV do extrato')
+    parser.add_argument('--categorias', help='planilha de categorias (.xlsx); padrão CATEGORIAS_EXEMPLO')
+    args = parser.parse_args()
+
+    sys.path.insert(0, DIRETORIO_API)
+    import extratos
+    extratos.carregar_dependencias()
+    handler = extratos.handler.__new__(extratos.handler)
+
+    with open(args.extrato, 'rb') as f:
+        df = handler.processar_csv(f.read())
+    if args.categorias:
+        with open(args.categorias, 'rb') as f:
+            categorias = handler.processar_excel(f.read())
+    else:
+        categorias = CATEGORIAS_EXEMPLO
+
+    # Sem hash da planilha: sem memo de comerciantes, só o casamento
+    atual = handler.categorizar_transacoes(df, categorias).astype(str).tolist()
+    palavras_ordenadas = sorted(categorias, key=len, reverse=True)
+    regressoes, ganhos = [], []
+    for descricao, tipo, categoria in zip(df['Descricao'].astype(str), df['Tipo'].astype(str), atual):
+        original = categoria_original(descricao, palavras_ordenadas, categorias)
+        if original == 'Outros':
+            original = f"Outros({'Débito' if tipo == 'D' else 'Crédito'})"
+            if categoria != original:
+                ganhos.append((descricao, original, categoria))
+        elif categoria != original:
+            regressoes.append((descricao, original, categoria))
+
+    # Palavras-chave curtas demais entram primeiro na planilha e mesmo assim não casam com nada
+    com_curtas = handler.categorizar_transacoes(df, {**PALAVRAS_CURTAS, **categorias}).astype(str).tolist()
+    curtas = [
+        (descricao, categoria, com_curta)
+        for descricao, categoria, com_curta in zip(df['Descricao'].astype(str), atual, com_curtas)
+        if com_curta != categoria
+    ]
+
+    print(f"{len(df)} transações, {len(categorias)} palavras-chave")
+    for titulo, lista in (('Novos casamentos (antes em Outros)', ganhos), ('Regressões', regressoes),
+                          (f"Mudanças com as palavras-chave curtas {', '.join(PALAVRAS_CURTAS)}", curtas)):
+        print(f"{titulo}: {len(lista)}")
+        for descricao, original, categoria in lista:
+            print(f"  {descricao!r}: {original} -> {categoria}")
+    if regressoes or curtas:
+        sys.exit(1)
+    print("Mesma categorização da versão original.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Verifica a gravação no histórico de /api/extratos (modos persistir e incremental) e a migração do banco.
+
+No incremental confere que a resposta e o Excel têm um escopo só: estatísticas e totais por categoria do
+histórico da conta, transações novas em 'novas' e nas abas por categoria, com totais que batem com as linhas.
+Na migração confere que um banco antigo é migrado uma vez (PRAGMA user_version) e não a cada conexão.
+
+Sobe o handler num servidor local, com histórico e cache de resultados em um diretório temporário,
+e envia o extrato de exemplo em api/ com as planilhas sintéticas de scripts/carga.py. Sai com
+código 1 se alguma verificação falhar.
+
+Uso:
+    python scripts/verificar_historico.py
+"""
+import base64
+import io
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import urllib.request
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIRETORIO_API = os.path.join(RAIZ, 'api')
+
+
+def abas_consistentes(excel_b64):
+    """Em cada aba de categoria o total impresso é a soma das linhas listadas"""
+    from openpyxl import load_workbook
+    livro = load_workbook(io.BytesIO(base64.b64decode(excel_b64)))
+    for aba in livro.worksheets[1:]:
+        linhas = list(aba.iter_rows(values_only=True))
+        if not linhas or not str(linhas[0][0] or '').startswith('CATEGORIA:'):
+            continue
+        valores = [linha[3] for linha in linhas[6:] if isinstance(linha[0], int)]
+        impresso = next(linha[3] for linha in linhas if len(linha) > 2 and str(linha[2] or '').startswith('TOTAL'))
+        if round(sum(valores), 2) != round(impresso, 2) or round(linhas[1][1], 2) != round(impresso, 2):
+            return False
+    return True
+
+
+def main():
+    diretorio = tempfile.mkdtemp(prefix='verificar-historico-')
+    historico_db = os.path.join(diretorio, 'historico.sqlite3')
+    # Antes de importar o handler: os caminhos são lidos na importação
+    os.environ.update(
+        EXTRATO_HISTORICO_DB=historico_db,
+        EXTRATO_MEMO_DB=os.path.join(diretorio, 'memo.sqlite3'),
+        RESULT_CACHE_DIR=os.path.join(diretorio, 'cache'),
+        API_LOG_NIVEL='WARNING'
+    )
+    sys.path.insert(0, DIRETORIO_API)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from http.server import ThreadingHTTPServer
+    import carga
+    import extratos
+
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), extratos.handler)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    arquivos = carga.entradas(0)['extratos']
+
+    def enviar(**campos):
+        corpo, boundary = carga.multipart(arquivos, {'modo_excel': 'omitir', **campos})
+        requisicao = urllib.request.Request(
+            f'http://127.0.0.1:{servidor.server_address[1]}/api/extratos', data=corpo,
+            headers={'Content-Type': f'multipart/form-data; boundary={boundary}'}
+        )
+        with urllib.request.urlopen(requisicao) as resposta:
+            return resposta.headers.get('X-Cache'), json.loads(resposta.read())
+
+    def gravadas():
+        if not os.path.exists(historico_db):
+            return 0
+        with sqlite3.connect(historico_db) as conexao:
+            return conexao.execute('SELECT COUNT(*) FROM transacoes').fetchone()[0]
+
+    def esquema():
+        with sqlite3.connect(historico_db) as conexao:
+            tabelas = {nome for nome, in conexao.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            return tabelas, conexao.execute('PRAGMA user_version').fetchone()[0]
+
+    def criar_tabela_antiga():
+        with sqlite3.connect(historico_db) as conexao:
+            conexao.execute('CREATE TABLE agregados (conta TEXT)')
+
+    def apagar_historico():
+        for sufixo in ('', '-wal', '-shm'):
+            if os.path.exists(historico_db + sufixo):
+                os.remove(historico_db + sufixo)
+
+    falhas = []
+
+    def verificar(condicao, descricao):
+        print(f"{'ok   ' if condicao else 'FALHA'} {descricao}")
+        if not condicao:
+            falhas.append(descricao)
+
+    # Banco de uma versão anterior (tabela agregados, sem versão): migrado no primeiro envio e só nele
+    criar_tabela_antiga()
+    enviar(persistir='1', conta='migracao')
+    tabelas, versao = esquema()
+    verificar('agregados' not in tabelas and versao == extratos.VERSAO_HISTORICO,
+              f"migração: tabela antiga removida e versão {extratos.VERSAO_HISTORICO} gravada")
+    criar_tabela_antiga()
+    enviar(persistir='1', conta='migracao')
+    verificar('agregados' in esquema()[0], "migração: não roda de novo a cada conexão")
+    apagar_historico()
+
+    # persistir=1 duas vezes com o histórico apagado no meio: o segundo envio grava de novo (não vem do cache)
+    cache, primeira = enviar(persistir='1', conta='verificacao')
+    total = primeira['estatisticas']['total_transacoes']
+    verificar(cache == 'MISS' and primeira['historico']['transacoes_gravadas'] == total == gravadas(),
+              f"persistir: primeiro envio grava as {total} transações")
+    apagar_historico()
+    cache, segunda = enviar(persistir='1', conta='verificacao')
+    verificar(cache == 'MISS', "persistir: reenvio não é respondido do cache")
+    verificar(segunda['historico']['transacoes_gravadas'] == total == gravadas(),
+              "persistir: reenvio com o histórico apagado grava de novo")
+    cache, terceira = enviar(persistir='1', conta='verificacao')
+    verificar(terceira['historico']['transacoes_gravadas'] == 0 and gravadas() == total,
+              "persistir: reenvio com o histórico intacto não duplica")
+
+    # incremental: o mesmo arquivo duas vezes (a segunda sem transações novas) e o resultado sem histórico
+    _, completo = enviar()
+    resumo = [(c['categoria'], round(c['total'], 2), c['quantidade']) for c in completo['categorias_gerais']]
+    for envio, novas in (('primeiro', total), ('reenvio', 0)):
+        _, resposta = enviar(incremental='1', conta='incremental', modo_excel='incluir')
+        estatisticas = resposta['estatisticas']
+        verificar(estatisticas['total_transacoes'] == total and estatisticas['valor_total_debitos'] == completo['estatisticas']['valor_total_debitos'],
+                  f"incremental ({envio}): estatísticas do histórico inteiro")
+        verificar([(c['categoria'], round(c['total'], 2), c['quantidade']) for c in resposta['categorias_gerais']] == resumo,
+                  f"incremental ({envio}): totais por categoria do histórico inteiro")
+        verificar(resposta['novas']['estatisticas']['total_transacoes'] == novas == resposta['incremental']['transacoes_novas']
+                  and sum(len(c['itens']) for c in resposta['novas']['categorias_gerais']) == novas,
+                  f"incremental ({envio}): {novas} transações novas em 'novas'")
+        verificar(abas_consistentes(resposta['excel_file']), f"incremental ({envio}): total de cada aba bate com as linhas")
+
+    servidor.shutdown()
+    shutil.rmtree(diretorio, ignore_errors=True)
+    if falhas:
+        sys.exit(1)
+    print("Histórico verificado.")
+
+
+if __name__ == '__main__':
+    main()